@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Measures the time from "python app.py" to "Listening on 8888", with stub
+# Ushahidi v3 and Capture upstreams served from this process.
+#
+#   python bench/startup.py [runs]
+#
+
+from tornado.web import Application, RequestHandler
+from tornado.ioloop import IOLoop
+from json import dumps
+import os, sys, time, signal, shutil, tempfile, threading, subprocess
+
+STUB_PORT = 18888
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+class StubHandler(RequestHandler):
+  def reply(self, obj):
+    self.set_header('Content-Type', 'application/json')
+    self.write(dumps(obj))
+
+class TokenHandler(StubHandler):
+  def post(self):
+    self.reply(dict(access_token="stub", expires=int(time.time()) + 3600, expires_in=3600))
+
+class FormsHandler(StubHandler):
+  def get(self):
+    self.reply(dict(results=[ dict(id=1, name="Themes") ]))
+
+class TagsHandler(StubHandler):
+  def get(self):
+    self.reply(dict(results=[]))
+
+class DatachannelsHandler(StubHandler):
+  def get(self):
+    self.reply(dict(dataChannel=[]))
+
+def start_stubs():
+  app = Application([
+    (r"/oauth/token", TokenHandler),
+    (r"/api/v3/forms", FormsHandler),
+    (r"/api/v3/tags", TagsHandler),
+    (r"/CaptureREST/rest/datachannel", DatachannelsHandler),
+    ])
+  loop = IOLoop()
+  def run():
+    loop.make_current()
+    app.listen(STUB_PORT, address="127.0.0.1")
+    loop.start()
+  t = threading.Thread(target=run)
+  t.daemon = True
+  t.start()
+
+def measure_once(state_dir):
+  env = dict(os.environ,
+    PLATFORM_HOST="127.0.0.1", PLATFORM_PORT=str(STUB_PORT),
+    CAPTURE_HOST="127.0.0.1", CAPTURE_PORT=str(STUB_PORT),
+    STATE_DIR_PATH=state_dir)
+  t0 = time.time()
+  p = subprocess.Popen([ sys.executable, "app.py", "--logging=info" ],
+    cwd=SRC_PATH, env=env, stdout=open(os.devnull, "w"), stderr=subprocess.PIPE)
+  try:
+    for line in iter(p.stderr.readline, ""):
+      if "Listening on 8888" in line:
+        return time.time() - t0
+      if "Fatal initialisation error" in line:
+        break
+    raise Exception("app.py did not start listening")
+  finally:
+    p.send_signal(signal.SIGINT)
+    p.wait()
+
+def main():
+  runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+  start_stubs()
+  state_dir = tempfile.mkdtemp()
+  try:
+    times = []
+    for i in range(runs):
+      times.append(measure_once(state_dir))
+      print("run %d: %.3fs" % (i + 1, times[-1]))
+    times.sort()
+    print("min %.3fs  median %.3fs  max %.3fs" % (times[0], times[len(times) / 2], times[-1]))
+  finally:
+    shutil.rmtree(state_dir)
+
+if __name__ == "__main__":
+  main()
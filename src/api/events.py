@@ -3,7 +3,7 @@ from tornado_json import gen
 from tornado_json.requesthandlers import APIHandler
 from tornado_json import schema
 from datetime import datetime, timedelta
-import logging
+import logging, time
 
 import my_json as json
 import capture_api
@@ -142,8 +142,12 @@ class EventStateHandler(ModelAPIHandler):
 
   @gen.coroutine
   def get(self, datachannel_id, action):
-    if action not in [ 'start', 'pause', 'reset' ]:
+    if action not in [ 'start', 'pause', 'reset', 'recompute', 'status' ]:
       self.fail("Unrecognizable state action %s" % action)
+    elif action == 'status':
+      prefix = "pull_themes_graphdb_channel_%s." % datachannel_id
+      values = yield state.scan(prefix)
+      self.success(dict(map(lambda (k, v): (k[len(prefix):], v), values.iteritems())))
     else:
       if action == 'start':
         state.set("pull_themes_graphdb_channel_%s.frozen" % datachannel_id, False)
@@ -151,6 +155,9 @@ class EventStateHandler(ModelAPIHandler):
         state.set("pull_themes_graphdb_channel_%s.frozen" % datachannel_id, True)
       elif action == 'reset':
         state.set("pull_themes_graphdb_channel_%s.last_update" % datachannel_id, None)
+      elif action == 'recompute':
+        # Stories counted before now are counted again from scratch when pushed
+        state.set("pull_themes_graphdb_channel_%s.recompute_before" % datachannel_id, time.time())
       self.success("OK")
 
 
@@ -0,0 +1,19 @@
+from tornado_json import gen
+from tornado_json.requesthandlers import APIHandler
+
+import state
+import http_clients
+import repositories.graphdb as graphdb
+import pull_push
+
+class StatsHandler(APIHandler):
+  __urls__ = [ '/api/stats' ]
+
+  def get(self):
+    self.success(dict(
+      state= state.stats(),
+      upstreams= http_clients.stats(),
+      graphdb_queries= graphdb.query_stats(),
+      graphdb_result_cache= graphdb.result_cache_stats(),
+      push= pull_push.stats(),
+      ))
@@ -30,7 +30,8 @@ class StoryDetailHandler(ModelAPIHandler):
       logger.error("/api/stories/%s -- story not found" % str(story_id))
       self.error("story %s is not in the database" % story_id)
       return
-    graphdb_story = graphdb.Story(channel_id= story.channel_id, event_id= story.event_id)
+    # last_activity lets graphdb serve cached results while the story doesn't change
+    graphdb_story = graphdb.Story(channel_id= story.channel_id, event_id= story.event_id, last_activity= story.last_activity)
     story = story.obj()
 
     logger.info("/api/stories/%s -- getting linked images" % str(story_id))
@@ -25,6 +25,20 @@ theme_pull_chunk_size = int(theme_pull_chunk_size)
 
 state_dir_path = os.environ["STATE_DIR_PATH"] if "STATE_DIR_PATH" in os.environ else "."
 
+state_backend = os.environ["STATE_BACKEND"] if "STATE_BACKEND" in os.environ else "shelve"
+
+state_shards = os.environ["STATE_SHARDS"] if "STATE_SHARDS" in os.environ else "1"
+state_shards = int(state_shards)
+
+state_sync_max_latency = os.environ["STATE_SYNC_MAX_LATENCY"] if "STATE_SYNC_MAX_LATENCY" in os.environ else "0.1"
+state_sync_max_latency = float(state_sync_max_latency)
+
+state_sync_max_batch = os.environ["STATE_SYNC_MAX_BATCH"] if "STATE_SYNC_MAX_BATCH" in os.environ else "256"
+state_sync_max_batch = int(state_sync_max_batch)
+
+state_cache_size = os.environ["STATE_CACHE_SIZE"] if "STATE_CACHE_SIZE" in os.environ else "4096"
+state_cache_size = int(state_cache_size)
+
 def make_app():
   import api
   routes = get_routes(api)
@@ -38,7 +52,13 @@ def make_app():
 @gen.coroutine
 def initialise_tasks():
   # Initialise state storage (state.db)
-  state.init(os.path.join(state_dir_path, 'state'))
+  state.init(os.path.join(state_dir_path, 'state'),
+    backend=state_backend,
+    shards=state_shards,
+    sync_max_latency=state_sync_max_latency,
+    sync_max_batch=state_sync_max_batch,
+    cache_size=state_cache_size)
+  register_task(state.StateMaintenanceTask(task_id="state-maintenance", first_delay=600), start=True)
 
   # Ush V3 link initialisation
   yield ush_v3.get_link().initialise_tasks()
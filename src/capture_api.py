@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest
 from tornado import gen
 
 import logging, os, time
@@ -8,6 +8,7 @@ from json import loads, dumps
 from urllib import urlencode
 
 from tasks import SelfRegulatingTask
+import http_clients
 
 capture_proto = os.environ["CAPTURE_PROTO"] if 'CAPTURE_PROTO' in os.environ else "http"
 capture_host = os.environ["CAPTURE_HOST"] if 'CAPTURE_HOST' in os.environ else "localhost"
@@ -78,8 +79,7 @@ def _do_request(endpoint, **kwargs):
   kwargs['headers']['Accept'] = 'application/json'
 
   r = HTTPRequest(CAPTURE_ENDPOINT + endpoint, **kwargs)
-  http_client = AsyncHTTPClient()
-  response = yield http_client.fetch(r)
+  response = yield http_clients.get_upstream('capture').fetch(r)
   if response.body == "":
     raise gen.Return({})
   else:
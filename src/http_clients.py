@@ -0,0 +1,249 @@
+# Shared HTTP clients for the upstream services (GraphDB, Capture, Ushahidi)
+# and for the hosts of the articles linked from the stories ("links").
+#
+# Each upstream gets its own client instance, so that a burst of requests to
+# one of them can't take all the client slots needed by the others. The curl
+# based client is used when pycurl is available (it's in requirements.txt), as
+# it keeps connections alive between requests, per host; otherwise tornado's
+# simple client is used, which opens a new connection for each request.
+#
+# Identical GET / HEAD requests to an upstream (same url, headers and body)
+# that are made while one of them is in flight share its response.
+#
+# Each upstream is configured from the environment:
+#   * <NAME>_MAX_CLIENTS : max number of concurrent requests
+#   * <NAME>_CONNECT_TIMEOUT : default connect timeout, in seconds
+#   * <NAME>_REQUEST_TIMEOUT : default request timeout, in seconds
+#
+# Callers can also bound the concurrency of their requests to an upstream with
+# an adaptive limiter (see AdaptiveLimiter), configured from:
+#   * <NAME>_MIN_CONCURRENCY / <NAME>_MAX_CONCURRENCY : bounds of the limit
+#   * <NAME>_TARGET_LATENCY : requests faster than this raise the limit
+
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.httpclient import HTTPRequest
+from tornado.concurrent import Future
+from tornado import gen, locks, httputil
+from collections import deque
+import logging, os, time
+
+try:
+  import pycurl
+  from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+  CurlAsyncHTTPClient = None
+
+logger = logging.getLogger('tornado.general')
+
+# Defaults for each of the upstreams
+_upstream_defaults = {
+  "graphdb": dict(max_clients=10, connect_timeout=30, request_timeout=300),
+  "capture": dict(max_clients=10, connect_timeout=20, request_timeout=20),
+  "ush_v3":  dict(max_clients=10, connect_timeout=20, request_timeout=20),
+  "links":   dict(max_clients=20, connect_timeout=5, request_timeout=10),
+}
+
+def _env(name, key, default, conv):
+  var = "%s_%s" % (name.upper(), key.upper())
+  return conv(os.environ[var]) if var in os.environ else default
+
+class SingleFlight(object):
+  """
+  Concurrent calls with the same key share the outcome of the first one:
+  while its Future is pending, further calls get that same Future.
+  """
+  def __init__(self):
+    self.in_flight = {}   # key -> Future
+    self.n_calls = 0
+    self.n_shared = 0
+
+  def do(self, key, fn):
+    # fn returns a Future, it is only called if no call with key is in flight
+    if key in self.in_flight:
+      self.n_shared += 1
+      return self.in_flight[key]
+    self.n_calls += 1
+    future = fn()
+    self.in_flight[key] = future
+    future.add_done_callback(lambda f: self.in_flight.pop(key, None))
+    return future
+
+class Upstream(object):
+  def __init__(self, name, max_clients=10, connect_timeout=20, request_timeout=20):
+    self.name = name
+    self.max_clients = max_clients
+    self.connect_timeout = connect_timeout
+    self.request_timeout = request_timeout
+    self.slots = locks.Semaphore(max_clients)
+    self.client = None
+    self.flights = SingleFlight()
+    # Request counters
+    self.n_requests = 0
+    self.n_errors = 0
+    self.n_waiting = 0          # requests currently waiting for a slot
+    self.n_active = 0           # requests currently in progress
+    self.total_queue_wait = 0.0 # seconds spent waiting for a slot
+    self.max_queue_wait = 0.0
+    self.total_time = 0.0       # seconds spent in requests (after getting a slot)
+
+  def _get_client(self):
+    # Created on first use, so that it binds to the running io loop
+    if self.client is None:
+      impl = CurlAsyncHTTPClient or SimpleAsyncHTTPClient
+      if CurlAsyncHTTPClient is None:
+        logger.warning("pycurl is not available, connections to upstream %s won't be kept alive" % self.name)
+      logger.info("Creating %s client for upstream %s (max_clients=%d)" % (impl.__name__, self.name, self.max_clients))
+      self.client = impl(force_instance=True,
+        max_clients=self.max_clients,
+        defaults=dict(connect_timeout=self.connect_timeout, request_timeout=self.request_timeout))
+    return self.client
+
+  def fetch(self, request, **kwargs):
+    # Same as AsyncHTTPClient.fetch, waiting for a free slot first
+    if isinstance(request, HTTPRequest) and request.method in [ 'GET', 'HEAD' ] and \
+       request.streaming_callback is None and len(kwargs) == 0:
+      # (headers may have been given as a plain dict)
+      headers = httputil.HTTPHeaders(request.headers)
+      key = (request.method, request.url, tuple(sorted(headers.get_all())), request.body)
+      return self.flights.do(key, lambda: self._fetch(request))
+    return self._fetch(request, **kwargs)
+
+  @gen.coroutine
+  def _fetch(self, request, **kwargs):
+    t0 = time.time()
+    self.n_waiting += 1
+    try:
+      yield self.slots.acquire()
+    finally:
+      self.n_waiting -= 1
+    wait = time.time() - t0
+    self.total_queue_wait += wait
+    self.max_queue_wait = max(self.max_queue_wait, wait)
+    #
+    self.n_requests += 1
+    self.n_active += 1
+    t1 = time.time()
+    try:
+      response = yield self._get_client().fetch(request, **kwargs)
+    except Exception:
+      self.n_errors += 1
+      raise
+    finally:
+      self.n_active -= 1
+      self.total_time += time.time() - t1
+      self.slots.release()
+    raise gen.Return(response)
+
+  def stats(self):
+    return dict(
+      max_clients= self.max_clients,
+      requests= self.n_requests,
+      errors= self.n_errors,
+      waiting= self.n_waiting,
+      active= self.n_active,
+      avg_queue_wait= self.total_queue_wait / self.n_requests if self.n_requests > 0 else 0.0,
+      max_queue_wait= self.max_queue_wait,
+      avg_time= self.total_time / self.n_requests if self.n_requests > 0 else 0.0,
+      shared= self.flights.n_shared,
+    )
+
+# Request priorities
+INTERACTIVE = 0   # on behalf of API clients
+BACKGROUND = 1    # from background tasks
+
+class AdaptiveLimiter(object):
+  """
+  Concurrency limit adjusted AIMD style: each request completed within
+  target_latency raises the limit by 1/limit (about +1 per round of
+  requests), while a request failing because the upstream is overloaded
+  (timeouts, 5xx) halves it. Failures of requests that were started before
+  the last decrease are not counted again, so that a burst of failures only
+  backs off once. Waiting interactive requests are let through before
+  background ones.
+  """
+  def __init__(self, name, min_limit=1, max_limit=10, target_latency=10.0):
+    self.name = name
+    self.min_limit = min_limit
+    self.max_limit = max_limit
+    self.target_latency = target_latency
+    self.limit = float(max(min_limit, max_limit / 2))
+    self.in_flight = 0
+    self.waiters = [ deque(), deque() ]   # by priority
+    self.last_decrease = 0.0
+    # Counters
+    self.n_increases = 0
+    self.n_decreases = 0
+    self.n_granted = [ 0, 0 ]   # by priority
+
+  def acquire(self, priority=INTERACTIVE):
+    # Returns a Future that resolves once the request can go ahead
+    future = Future()
+    self.waiters[priority].append(future)
+    self._grant()
+    return future
+
+  def release(self, started, overloaded=False):
+    # started is the time the request was let through
+    self.in_flight -= 1
+    if overloaded:
+      if started >= self.last_decrease:
+        self.limit = max(float(self.min_limit), self.limit / 2)
+        self.last_decrease = time.time()
+        self.n_decreases += 1
+        logger.info("Concurrency limit for %s decreased to %d" % (self.name, int(self.limit)))
+    elif time.time() - started <= self.target_latency and self.limit < self.max_limit:
+      self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+      self.n_increases += 1
+    self._grant()
+
+  def _grant(self):
+    while self.in_flight < int(self.limit):
+      priorities = filter(lambda p: len(self.waiters[p]) > 0, [ INTERACTIVE, BACKGROUND ])
+      if len(priorities) == 0:
+        return
+      future = self.waiters[priorities[0]].popleft()
+      self.in_flight += 1
+      self.n_granted[priorities[0]] += 1
+      future.set_result(None)
+
+  def stats(self):
+    return dict(
+      limit= int(self.limit),
+      in_flight= self.in_flight,
+      waiting_interactive= len(self.waiters[INTERACTIVE]),
+      waiting_background= len(self.waiters[BACKGROUND]),
+      granted_interactive= self.n_granted[INTERACTIVE],
+      granted_background= self.n_granted[BACKGROUND],
+      increases= self.n_increases,
+      decreases= self.n_decreases,
+    )
+
+# Upstream instances, by name
+_upstreams = {}
+
+def get_upstream(name):
+  if name not in _upstreams:
+    defaults = _upstream_defaults.get(name, {})
+    _upstreams[name] = Upstream(name,
+      max_clients= _env(name, 'max_clients', defaults.get('max_clients', 10), int),
+      connect_timeout= _env(name, 'connect_timeout', defaults.get('connect_timeout', 20), float),
+      request_timeout= _env(name, 'request_timeout', defaults.get('request_timeout', 20), float))
+  return _upstreams[name]
+
+# Limiter instances, by upstream name
+_limiters = {}
+
+def get_limiter(name):
+  if name not in _limiters:
+    max_clients = get_upstream(name).max_clients
+    _limiters[name] = AdaptiveLimiter(name,
+      min_limit= _env(name, 'min_concurrency', 1, int),
+      max_limit= _env(name, 'max_concurrency', max_clients, int),
+      target_latency= _env(name, 'target_latency', 10.0, float))
+  return _limiters[name]
+
+def stats():
+  ret = dict(map(lambda (name, upstream): (name, upstream.stats()), _upstreams.iteritems()))
+  for (name, limiter) in _limiters.iteritems():
+    ret[name]['limiter'] = limiter.stats()
+  return ret
@@ -1,11 +1,11 @@
 # Pull & push logic and tasks
 
-from tornado import gen
-import logging
+from tornado import gen, locks, queues
+import logging, hashlib, time, traceback
 
 logger = logging.getLogger('tornado.general')
 
-from tasks import FuzzyRecurrentTask, register_task
+from tasks import FuzzyRecurrentTask, register_task, task_roster
 from repositories import graphdb, ush_v3
 import capture_api
 import state
@@ -13,41 +13,71 @@ import model
 
 # Pull Themes (aka Stories) from GraphDB
 class PullThemesGraphDb(object):
-  def __init__(self, channel, chunk_size=24):
+  def __init__(self, channel, chunk_size=24, max_story_retries=3):
     self.channel = channel
     self.chunk_size = chunk_size
     self.x_chunk_size = chunk_size  # we increase the chunk size sometimes
+    self.max_story_retries = max_story_retries
     self.last_date = None
     self.last_first_event_id = None
+    self.last_pull_full = False     # whether the last pull got a whole chunk
+    self.story_failures = {}        # story id -> times it failed to be pushed
 
-  def _save_last_update(self, datetime):
-    state.set("pull_themes_graphdb_channel_%s.last_update" % self.channel._id, datetime)
+  def _state_key(self, name):
+    return "pull_themes_graphdb_channel_%s.%s" % (self.channel._id, name)
 
-  @gen.coroutine
-  def _get_last_update(self):
-    v = yield state.get("pull_themes_graphdb_channel_%s.last_update" % self.channel._id)
-    raise gen.Return(v)
+  def _save_last_update(self, datetime):
+    state.set(self._state_key("last_update"), datetime)
 
   @gen.coroutine
-  def _get_frozen(self):
-    v = yield state.get("pull_themes_graphdb_channel_%s.frozen" % self.channel._id)
-    raise gen.Return(v)
+  def _get_frozen_and_last_update(self):
+    frozen_key, last_update_key = self._state_key("frozen"), self._state_key("last_update")
+    v = yield state.get_many([ frozen_key, last_update_key ])
+    raise gen.Return((v[frozen_key], v[last_update_key]))
 
   @gen.coroutine
-  def pull(self):   # pull chunk
+  def pull(self, since=None):   # pull chunk, from the last update or since the given datetime
+    frozen, last_update = yield self._get_frozen_and_last_update()
     # Check if the data channel (event/topic) is frozen
-    frozen = yield self._get_frozen()
     if frozen:
+      self.last_pull_full = False
       raise gen.Return([])
-    # Pull the last update datetime
-    self.last_date = yield self._get_last_update()
+    if since is None:
+      # Pull the last update datetime
+      self.last_date = last_update
+      since = self.last_date
     #
-    stories = yield graphdb.Story.fetch_updated_since(self.channel, since=self.last_date, limit=self.x_chunk_size)
+    limit = self.x_chunk_size
+    stories = yield graphdb.Story.fetch_updated_since(self.channel, since=since, limit=limit)
+    self.last_pull_full = len(stories) >= limit
     logger.info("(dc=%s) pull query received stories [%s]: " % (self.channel._id, ",".join(map(lambda x: x._id , stories))))
     raise gen.Return(stories)
 
-  def set_consumed(self, chunk):
-    if len(chunk) > 0:
+  def _consumed_prefix(self, chunk, failed):
+    # The stories of the chunk up to the first one that failed to be pushed
+    # (pulled again next time). Stories that keep failing are given up after
+    # max_story_retries attempts.
+    for (i, story) in enumerate(chunk):
+      if story._id not in failed:
+        self.story_failures.pop(story._id, None)
+        continue
+      n = self.story_failures.get(story._id, 0) + 1
+      if n < self.max_story_retries:
+        self.story_failures[story._id] = n
+        return chunk[:i]
+      logger.error("Giving up on story %s after %d failed attempts" % (story._id, n))
+      self.story_failures.pop(story._id, None)
+    return chunk
+
+  def set_consumed(self, chunk, failed=set()):
+    # Stories are pulled in order of last activity, the pull goes on from the
+    # last one consumed, even if the stories were pushed out of order.
+    # Returns whether the whole chunk was consumed
+    consumed = self._consumed_prefix(chunk, failed)
+    if len(consumed) < len(chunk):
+      # Not stuck, the failed story will be retried
+      logger.info("Pulling again from story %s, which failed to be pushed" % chunk[len(consumed)]._id)
+    elif len(chunk) > 0:
       last_first_event_id = chunk[0].event_id
 
       if last_first_event_id == self.last_first_event_id:
@@ -60,88 +90,344 @@ class PullThemesGraphDb(object):
         self.x_chunk_size = self.chunk_size
         self.last_first_event_id = last_first_event_id
       
-      self.last_date = chunk[-1].last_activity
+    if len(consumed) > 0:
+      self.last_date = consumed[-1].last_activity
       self._save_last_update(self.last_date)
+    return len(consumed) == len(chunk)
+
 
+# Cached story data is forgotten after a month without updates
+STORY_CACHED_DATA_TTL = 30 * 24 * 3600
+
+# Fulltext uploaded to ushahidi is capped to this many characters
+FULLTEXT_MAX_LENGTH = 65535
+
+# Stories counters are recomputed from scratch at least this often (seconds)
+FULL_RECOMPUTE_INTERVAL = 24 * 3600
 
 # Push Themes (aka Stories) to ushahidi v3
 class PushThemesUshV3(object):
-  def __init__(self, min_cluster_size=2):
+  def __init__(self, min_cluster_size=2, full_recompute_interval=FULL_RECOMPUTE_INTERVAL, concurrency=4):
     self.min_cluster_size = min_cluster_size
+    self.concurrency = concurrency
+    self.full_recompute_interval = full_recompute_interval
+    # Stories pushed / skipped (by reason) / failed
+    self.counters = dict(pushed=0, failed=0, skipped_unchanged=0, skipped_no_data=0, skipped_small=0, skipped_same_size=0)
+
+  # This is an optimisation to avoid processing stories that haven't changed:
+  # once a story is processed, its fingerprint (last activity and source type,
+  # as pulled, and size) is kept in state. Stories pulled again with the same
+  # last activity are dropped before any other query, and stories whose size
+  # hasn't changed are dropped before their details are fetched. Fingerprints
+  # taken before the recompute_before time of the channel are disregarded.
+  def _fingerprint_key(self, story):
+    return "story_cached_data.%s.fingerprint" % story._id
 
-  # This is an optimisation to avoid processing stories that haven't changed
-  def _size_remember(self, story):
-    state.set("story_cached_data.%s.size" % story._id, int(story.size))
+  def _recompute_key(self, story):
+    return "pull_themes_graphdb_channel_%s.recompute_before" % story.channel_id
 
   @gen.coroutine
-  def _size_has_grown(self, story, size):
-    if size is None:
-      raise Exception("Can't tell if story of unknown size has grown!")
-    #
-    v = yield state.get("story_cached_data.%s.size" % story._id)
-    if v is None:
-      raise gen.Return(True)
+  def _fingerprints_recall(self, stories):
+    # Returns story id -> dict(last_activity, source_type, size, at)
+    keys = map(self._fingerprint_key, stories)
+    recompute_keys = list(set(map(self._recompute_key, stories)))
+    v = yield state.get_many(keys + recompute_keys)
+    ret = {}
+    for story in stories:
+      fingerprint = v[self._fingerprint_key(story)]
+      recompute_before = v[self._recompute_key(story)]
+      if fingerprint is not None and recompute_before is not None and fingerprint['at'] < recompute_before:
+        fingerprint = None
+      ret[story._id] = fingerprint
+    raise gen.Return(ret)
+
+  def _fingerprints_remember(self, stories_sizes):
+    # Takes a list of (story, size) pairs
+    now = time.time()
+    state.set_many(dict(map(lambda (story, size): (self._fingerprint_key(story),
+      dict(last_activity=story.last_activity, source_type=story.source_type, size=size, at=now)),
+      stories_sizes)), ttl=STORY_CACHED_DATA_TTL)
+
+  def _is_unchanged(self, story, fingerprint):
+    return fingerprint is not None and \
+      fingerprint['last_activity'] == story.last_activity and \
+      fingerprint['source_type'] == story.source_type
+
+  # Tweet texts are collected incrementally: the cleaned texts seen so far
+  # for a story are kept in state, with the creation date of the latest one,
+  # so that only texts created since then have to be fetched. Texts stop
+  # being collected once they fill the fulltext. The digest of the uploaded
+  # fulltext is kept too, to upload it again only if it has changed. The texts
+  # of a story are as large as a fulltext, so they are kept out of the state
+  # cache (see state.DEFAULT_CACHE_TTLS).
+  def _texts_key(self, story):
+    return "story_texts.%s" % story._id
+
+  @gen.coroutine
+  def _texts_recall(self, stories):
+    # Returns story id -> dict(since, texts, digest, ush_id)
+    keys = map(self._texts_key, stories)
+    v = yield state.get_many(keys)
+    raise gen.Return(dict(map(lambda story: (story._id, v[self._texts_key(story)]), stories)))
+
+  def _texts_merge(self, texts, new_texts):
+    texts = list(texts)
+    seen = set(texts)
+    length = sum(map(len, texts)) + len(texts)
+    for text in new_texts:
+      if length >= FULLTEXT_MAX_LENGTH:
+        break
+      if text not in seen:
+        seen.add(text)
+        texts.append(text)
+        length += len(text) + 1
+    return tuple(texts)
+
+  @gen.coroutine
+  def _upload_fulltext(self, v3_story, title, recalled, snapshot):
+    recalled = recalled or dict(since=None, texts=(), digest=None, ush_id=None)
+    texts = self._texts_merge(recalled['texts'], snapshot['tweet_texts'])
+    fulltext = ' '.join([model.clean_text(title)] + list(texts))[:FULLTEXT_MAX_LENGTH]
+    digest = hashlib.md5(fulltext.encode('utf-8')).hexdigest()
+    if digest != recalled['digest'] or v3_story._ush_id != recalled['ush_id']:
+      yield v3_story.upload_fulltext(fulltext)
     else:
-      raise gen.Return(int(size) > int(v))
+      logger.info("Not uploading fulltext of story %s because it hasn't changed" % v3_story._id)
+    # (texts were fetched from recalled['since'] on, so the new date is later)
+    since = snapshot['tweet_texts_until'] or recalled['since']
+    state.set(self._texts_key(v3_story),
+      dict(since=since, texts=texts, digest=digest, ush_id=v3_story._ush_id),
+      ttl=STORY_CACHED_DATA_TTL)
+
+  # The counters of a story (size, verified count, distinct image and URL
+  # digests, sdq counts) are kept in state, with the creation date of the
+  # latest tweet counted, so that only the tweets created since then have to
+  # be counted and added. Tweets that make it to GraphDB late, with an earlier
+  # creation date, are only counted by a full recompute, which happens
+  # periodically (every full_recompute_interval) and on demand (the
+  # recompute_before time of the channel, see api/events.py).
+  def _aggregates_key(self, story):
+    return "story_cached_data.%s.aggregates" % story._id
 
   @gen.coroutine
-  def push(self, chunk):    # push chunk
-    logger.info("push task query received stories [%s]: " % (",".join(map(lambda x: x._id , chunk))))
+  def _aggregates_recall(self, stories):
+    # Returns story id -> dict(since, full_at, size, verified_count, start_date,
+    # images, urls, sdq), None for the stories that need a full recompute
+    keys = map(self._aggregates_key, stories)
+    recompute_keys = list(set(map(self._recompute_key, stories)))
+    v = yield state.get_many(keys + recompute_keys)
+    now = time.time()
+    ret = {}
+    for story in stories:
+      aggregates = v[self._aggregates_key(story)]
+      recompute_before = v[self._recompute_key(story)]
+      if aggregates is not None:
+        if aggregates['full_at'] < now - self.full_recompute_interval:
+          aggregates = None
+        elif recompute_before is not None and aggregates['full_at'] < recompute_before:
+          aggregates = None
+      ret[story._id] = aggregates
+    raise gen.Return(ret)
+
+  def _url_digest(self, url):
+    # URLs are kept as 64 bit digests, to bound the size of the state
+    return int(hashlib.md5(url.encode('utf-8')).hexdigest()[:16], 16)
+
+  def _aggregates_merge(self, aggregates, delta):
+    if aggregates is None:
+      aggregates = dict(since=None, full_at=time.time(), size=0, verified_count=0, start_date=None,
+                        images=frozenset(), urls=frozenset(), sdq={})
+    if delta is None:
+      return aggregates
+    sdq = dict(aggregates['sdq'])
+    for (sdq_type, count) in delta['sdq'].iteritems():
+      sdq[sdq_type] = sdq.get(sdq_type, 0) + count
+    return dict(
+      since= max(aggregates['since'], delta['until']) if aggregates['since'] is not None else delta['until'],
+      full_at= aggregates['full_at'],
+      size= aggregates['size'] + delta['size'],
+      verified_count= aggregates['verified_count'] + delta['verified_count'],
+      start_date= min(aggregates['start_date'], delta['start_date']) if aggregates['start_date'] is not None else delta['start_date'],
+      images= aggregates['images'] | frozenset(map(self._url_digest, delta['images'])),
+      urls= aggregates['urls'] | frozenset(map(self._url_digest, delta['urls'])),
+      sdq= sdq)
+
+  @gen.coroutine
+  def _aggregates_update(self, stories):
+    # Brings the stored counters of the stories up to date and returns them as
+    # story id -> counters, leaving out the stories without tweets
+    recalled = yield self._aggregates_recall(stories)
+    since = dict(map(lambda (story_id, v): (story_id, v['since']),
+                     filter(lambda (story_id, v): v is not None, recalled.iteritems())))
+    logger.info("Counting tweets of %d stories, %d of them from scratch" % (len(stories), len(stories) - len(since)))
+    deltas = yield graphdb.Story.fetch_aggregates_many(stories, since=since)
+    ret = {}
+    updated = {}
+    for story in stories:
+      delta = deltas.get(story._id)
+      if recalled[story._id] is None and delta is None:
+        continue
+      ret[story._id] = self._aggregates_merge(recalled[story._id], delta)
+      if delta is not None or recalled[story._id] is None:
+        updated[self._aggregates_key(story)] = ret[story._id]
+    if len(updated) > 0:
+      state.set_many(updated, ttl=STORY_CACHED_DATA_TTL)
+    raise gen.Return(ret)
+
+  def _unique_stories(self, chunk):
+    # The same story can be pulled more than once in a chunk (once per source
+    # type of its tweets). Only the one with the latest activity is kept, as
+    # the stories are bound in VALUES blocks, which would count their tweets
+    # once per occurrence.
+    latest = {}
     for story in chunk:
-      # Convert data model to V3 and save
-      # Fetch additional details
-      xmeta = yield story.get_extended_metadata()
+      if story._id not in latest or \
+          (story.last_activity, story.source_type) > (latest[story._id].last_activity, latest[story._id].source_type):
+        latest[story._id] = story
+    return filter(lambda story: latest[story._id] is story, chunk)
+
+  @gen.coroutine
+  def push(self, chunk):    # push chunk, returns the ids of the stories that failed
+    logger.info("push task query received stories [%s]: " % (",".join(map(lambda x: x._id , chunk))))
+    chunk = self._unique_stories(chunk)
+    # Drop the stories that haven't changed since they were processed
+    fingerprints = yield self._fingerprints_recall(chunk)
+    changed = filter(lambda story: not self._is_unchanged(story, fingerprints[story._id]), chunk)
+    self.counters['skipped_unchanged'] += len(chunk) - len(changed)
+    if len(changed) < len(chunk):
+      logger.info("Skipping %d stories that haven't changed" % (len(chunk) - len(changed)))
 
+    # Bring the counters of the changed stories up to date
+    aggregates = yield self._aggregates_update(changed)
+    candidates = []
+    skipped = []    # (story, size) of the stories processed by skipping them
+    for story in changed:
+      if story._id not in aggregates:
+        xmeta = None
+      else:
+        x = aggregates[story._id]
+        xmeta = dict(
+          size= x['size'],
+          start_date= x['start_date'],
+          verified_count= x['verified_count'],
+          img_count= len(x['images']),
+          pub_count= len(x['urls']),
+          controversiality= graphdb.controversiality_score(x['sdq']))
+      if xmeta is None:
+        logger.info("Skipping story %s because there's no metadata for it" % story._id)
+        self.counters['skipped_no_data'] += 1
+        skipped.append((story, None))
+        continue
       # Skip clusters that are too small
       if xmeta['size'] < self.min_cluster_size:
         logger.info("Skipping story %s because it's too small (size=%d)" % (story._id, xmeta['size']))
+        self.counters['skipped_small'] += 1
+        skipped.append((story, xmeta['size']))
         continue
-      # Skip clusters that haven't grown
-      if not self._size_has_grown(story, xmeta['size']):
+      # Skip clusters whose size hasn't changed
+      fingerprint = fingerprints[story._id]
+      if fingerprint is not None and fingerprint['size'] == xmeta['size']:
         logger.info("Skipping story %s because it hasn't grown" % story._id)
+        self.counters['skipped_same_size'] += 1
+        skipped.append((story, xmeta['size']))
         continue
+      candidates.append((story, xmeta))
+
+    # The stories may have evolved, fetch more details (all in one query),
+    # only the tweet texts created since the last push are needed
+    candidate_stories = map(lambda (story, xmeta): story, candidates)
+    recalled_texts = yield self._texts_recall(candidate_stories)
+    texts_since = dict(map(lambda (story_id, v): (story_id, v['since']),
+                           filter(lambda (story_id, v): v is not None, recalled_texts.iteritems())))
+    snapshots = yield graphdb.Story.fetch_snapshot_many(candidate_stories, texts_since=texts_since)
+
+    # Save the stories, up to self.concurrency of them at a time (the stories
+    # are unique, so two saves of the same theme never run at once, which
+    # could both create its post)
+    slots = locks.Semaphore(self.concurrency)
+    pushed = yield map(lambda (story, xmeta):
+      self._push_story_isolated(slots, story, xmeta, snapshots.get(story._id), recalled_texts[story._id]),
+      candidates)
+    failed = set(map(lambda ((story, xmeta), ok): story._id, filter(lambda (c, ok): not ok, zip(candidates, pushed))))
+    if len(failed) > 0:
+      logger.info("Failed to push stories [%s]" % ",".join(failed))
+    self.counters['pushed'] += len(candidates) - len(failed)
+    self.counters['failed'] += len(failed)
+
+    # Remember the stories processed, in case we see them again
+    self._fingerprints_remember(skipped +
+      map(lambda (story, xmeta): (story, xmeta['size']), filter(lambda (story, xmeta): story._id not in failed, candidates)))
+    raise gen.Return(failed)
 
-      # The story may have evolved, fetch more details
-      title = yield story.get_latest_title()
-      featured_tweet = yield story.get_featured_tweet()
-      controversiality = yield story.get_controversiality_score()
-      images = yield story.get_linked_images()
-      images = sorted(images, lambda x,y: y['count'] - x['count'])
-      most_shared_img = images[0]['imgUrl'] if len(images) > 0 else ""
-      veracity_data = yield story.get_last_veracity()
-      tweet_texts = yield story.get_tweet_texts()
-
-      # Create and save the story on the ush_v3 repository
-      v3_story = ush_v3.Story.as_copy(story,
-        title= title,
-        size= xmeta['size'],
-        start_date= xmeta['start_date'],
-        img_count= xmeta['img_count'],
-        pub_count= xmeta['pub_count'],
-        verified_count = xmeta['verified_count'],
-        featured_tweet= featured_tweet,
-        controversiality= controversiality,
-        most_shared_img = most_shared_img,
-        veracity = veracity_data['veracity'],
-        veracity_score = veracity_data['veracity_score']
-        )
-
-      yield v3_story.save()
-      yield v3_story.upload_fulltext(' '.join([model.clean_text(title)] + tweet_texts))
-
-      # Save size of the story in case we see it again (used by _size_has_grown)
-      self._size_remember(v3_story)
+  @gen.coroutine
+  def _push_story_isolated(self, slots, story, xmeta, snapshot, recalled_texts):
+    # _push_story, once there's a free slot. Errors are logged instead of
+    # raised, so that they don't affect the other stories. Returns whether
+    # the story was pushed. A story without a snapshot is failed, so that it's
+    # retried
+    if snapshot is None:
+      logger.info("Failed to push story %s because there's no snapshot for it" % story._id)
+      raise gen.Return(False)
+    yield slots.acquire()
+    ok = False
+    try:
+      yield self._push_story(story, xmeta, snapshot, recalled_texts)
+      ok = True
+    except Exception:
+      logger.error("Exception pushing story %s" % story._id)
+      logger.error(traceback.format_exc())
+    finally:
+      slots.release()
+    raise gen.Return(ok)
+
+  @gen.coroutine
+  def _push_story(self, story, xmeta, snapshot, recalled_texts):
+    # Convert data model to V3 and save
+    title = snapshot['title']
+    featured_tweet = snapshot['featured_tweet']
+    images = sorted(snapshot['images'], lambda x,y: y['count'] - x['count'])
+    most_shared_img = images[0]['imgUrl'] if len(images) > 0 else ""
+    veracity_data = snapshot['veracity']
+
+    # Create and save the story on the ush_v3 repository
+    v3_story = ush_v3.Story.as_copy(story,
+      title= title,
+      size= xmeta['size'],
+      start_date= xmeta['start_date'],
+      img_count= xmeta['img_count'],
+      pub_count= xmeta['pub_count'],
+      verified_count = xmeta['verified_count'],
+      featured_tweet= featured_tweet,
+      controversiality= xmeta['controversiality'],
+      most_shared_img = most_shared_img,
+      veracity = veracity_data['veracity'],
+      veracity_score = veracity_data['veracity_score']
+      )
+
+    yield v3_story.save()
+    yield self._upload_fulltext(v3_story, title, recalled_texts, snapshot)
 
 
 # Remember to set
 #   * task_id : to identify this task instance from others
 #   * period: run pull/push action every N seconds
 #   * first_delay: wait N seconds for the first run
+#
+# In pipelined mode, the next chunk is pulled while the current one is being
+# pushed, from the last activity of the current chunk (the pull watermark is
+# only saved once the chunk is pushed). Pulled chunks wait in a queue of up
+# to prefetch chunks. While the chunks pulled come back full, pulling goes on
+# for up to catch_up_budget seconds, then the task runs again right away
+# instead of waiting for its period. The budget is at most half the task
+# timeout, the other half is left for the chunks in flight by then.
 class PullPushTask(FuzzyRecurrentTask):
-  def __init__(self, pull, push, **kwargs):
+  def __init__(self, pull, push, pipelined=True, prefetch=1, catch_up_budget=120, **kwargs):
     super(PullPushTask, self).__init__(**kwargs)
     self.pull = pull
     self.push = push
+    self.pipelined = pipelined
+    self.prefetch = prefetch
+    self.catch_up_budget = min(catch_up_budget, self.timeout / 2.0)
 
   @gen.coroutine
   def workload(self):
@@ -151,11 +437,69 @@ class PullPushTask(FuzzyRecurrentTask):
     #   raise gen.Return()
     #
     logger.info("[%s] doing pull/push" % self.task_id)
-    chunk = yield self.pull.pull()
-    yield self.push.push(chunk)
-    self.pull.set_consumed(chunk)
+    if self.pipelined:
+      yield self._pipelined_pull_push()
+    else:
+      chunk = yield self.pull.pull()
+      failed = yield self.push.push(chunk)
+      self.pull.set_consumed(chunk, failed)
     logger.info("[%s] pull/push finished" % self.task_id)
 
+  @gen.coroutine
+  def _pull_chunks(self, chunks, run):
+    # Pulls chunks into the chunks queue, each one from the last activity of
+    # the previous one, until there are no more full chunks, the time budget
+    # is spent or run['stop'] is set. None is put in the queue at the end.
+    try:
+      since = None
+      while True:
+        chunk = yield self.pull.pull(since=since)
+        yield chunks.put(chunk)
+        if run['stop'] or not self.pull.last_pull_full:
+          break
+        if since is not None and chunk[-1].last_activity <= since:
+          # no progress, the chunk size has to grow (see set_consumed)
+          break
+        if time.time() > run['deadline']:
+          run['catching_up'] = True
+          break
+        since = chunk[-1].last_activity
+    finally:
+      yield chunks.put(None)
+
+  @gen.coroutine
+  def _pipelined_pull_push(self):
+    chunks = queues.Queue(maxsize=self.prefetch)
+    run = dict(stop=False, deadline=time.time() + self.catch_up_budget, catching_up=False)
+    puller = self._pull_chunks(chunks, run)
+    error = None
+    while True:
+      chunk = yield chunks.get()
+      if chunk is None:
+        break
+      if run['stop']:
+        continue    # drop the chunks pulled ahead
+      try:
+        failed = yield self.push.push(chunk)
+        if not self.pull.set_consumed(chunk, failed):
+          # The chunks pulled ahead would skip the stories to retry
+          run['stop'] = True
+      except Exception as e:
+        logger.error(traceback.format_exc())
+        run['stop'] = True
+        error = e
+    yield puller
+    if error is not None:
+      raise error
+    if run['catching_up'] and not run['stop']:
+      logger.info("[%s] catching up, running again right away" % self.task_id)
+      self.skip_next_sleep = True
+
+
+def stats():
+  # Push counters of the pull/push tasks, by task id
+  return dict(map(lambda task: (task.task_id, task.push.counters),
+                  filter(lambda task: isinstance(task, PullPushTask), task_roster.values())))
 
 def create_themes_pull_task(channel, **kwargs):
   logger.info("Creating task on channel %s with args %s" % (channel, str(kwargs)))
@@ -165,10 +509,18 @@ def create_themes_pull_task(channel, **kwargs):
   chunk_size = kwargs['chunk_size'] if 'chunk_size' in kwargs else 24
   first_delay = kwargs['first_delay'] if 'first_delay' in kwargs else (0, 15)
   min_cluster_size = kwargs['min_cluster_size'] if 'min_cluster_size' in kwargs else 2
+  full_recompute_interval = kwargs['full_recompute_interval'] if 'full_recompute_interval' in kwargs else FULL_RECOMPUTE_INTERVAL
+  push_concurrency = kwargs['push_concurrency'] if 'push_concurrency' in kwargs else 4
+  max_story_retries = kwargs['max_story_retries'] if 'max_story_retries' in kwargs else 3
+  pipelined = kwargs['pipelined'] if 'pipelined' in kwargs else True
+  prefetch = kwargs['prefetch'] if 'prefetch' in kwargs else 1
+  catch_up_budget = kwargs['catch_up_budget'] if 'catch_up_budget' in kwargs else 120
 
-  pull = PullThemesGraphDb(channel, chunk_size=chunk_size)
-  push = PushThemesUshV3(min_cluster_size=min_cluster_size)
-  task = PullPushTask(pull, push, task_id=task_id, period=period, first_delay=first_delay)
+  pull = PullThemesGraphDb(channel, chunk_size=chunk_size, max_story_retries=max_story_retries)
+  push = PushThemesUshV3(min_cluster_size=min_cluster_size, full_recompute_interval=full_recompute_interval,
+    concurrency=push_concurrency)
+  task = PullPushTask(pull, push, pipelined=pipelined, prefetch=prefetch, catch_up_budget=catch_up_budget,
+    task_id=task_id, period=period, first_delay=first_delay)
 
   return task
 
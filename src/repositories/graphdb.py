@@ -1,20 +1,30 @@
 #!/usr/bin/env python
 
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest, HTTPError
 from tornado import gen
-from json import loads
-from rdflib.plugins.sparql.results.jsonresults import JSONResult
 from datetime import datetime
 
 from string import Template
-import logging, urllib, pytz, os, re
+from collections import OrderedDict
+import logging, urllib, pytz, os, re, functools, time
+import cPickle as pickle
 
 import iso8601
 
+import http_clients
+import sparql_results
+
 GRAPHDB_ENDPOINT = os.environ["GRAPHDB_ENDPOINT"] if "GRAPHDB_ENDPOINT" in os.environ else 'http://pheme.ontotext.com/repositories/pheme'
 
 GRAPHDB_PHEME_VERSIONS = [ "v8" ]
 
+# Decoder for the query results, see repositories/sparql_results.py
+GRAPHDB_RESULTS_DECODER = os.environ["GRAPHDB_RESULTS_DECODER"] if "GRAPHDB_RESULTS_DECODER" in os.environ else 'native'
+
+# Memory budget of the story results cache, in bytes
+GRAPHDB_RESULT_CACHE_BYTES = os.environ["GRAPHDB_RESULT_CACHE_BYTES"] if "GRAPHDB_RESULT_CACHE_BYTES" in os.environ else str(64*1024*1024)
+GRAPHDB_RESULT_CACHE_BYTES = int(GRAPHDB_RESULT_CACHE_BYTES)
+
 logger = logging.getLogger('tornado.general')
 
 _graphdb_pheme_versions = "(%s)" % ",".join(map(lambda v: "\"%s\"" % v, GRAPHDB_PHEME_VERSIONS))
@@ -34,198 +44,454 @@ def _avatar_process(url):
     return "https://abs.twimg.com/sticky/default_profile_images/default_profile_2_bigger.png"
 
 def _str_to_bool(str):
+  if isinstance(str, bool):
+    return str
   return (str or "").lower() in [ 'true', '1' ]
 
+def _to_datetime(v):
+  # dateTime typed results are already decoded, plain literals are parsed
+  if isinstance(v, datetime):
+    return v
+  return iso8601.parse_date(v)
+
+def _rows_by_story(result):
+  # Split result rows by the story they belong to (from ?eventId and ?dataChannelId)
+  ret = {}
+  for x in result:
+    story_id = model.Story.idgen(unicode(x['dataChannelId']), unicode(x['eventId']))
+    ret.setdefault(story_id, []).append(x)
+  return ret
+
+def _parse_featured_tweet(x):
+  source_type = unicode(x['sourceType'])
+  # Decode source to tweet id
+  if source_type.lower() == 'twitter':
+    tweet_id = re.match(r'.*\D(\d+)$', unicode(x['source']))
+    if tweet_id is None:
+      raise Exception("Unparseable tweet_id from result %s" % str(x))
+    else:
+      tweet_id = tweet_id.groups()[0]
+  else:
+    tweet_id = "#%s-noid" % source_type
+  return dict(
+    tweet_id= tweet_id,
+    text= unicode(x['text']),
+    date= _to_datetime(x['date']),
+    user= dict(
+      profile_image_url = _avatar_process(x['avatar']),
+      user_description= x['userName'],
+      user_screen_name= x['userHandle']),
+      is_verified = _str_to_bool(x['verified'])
+    )
+
+def _parse_linked_image(x):
+  return dict(
+    date= _to_datetime(x['date']),
+    imgUrl= unicode(x['imageURL']),
+    count= int(x['countImage']))
+
+def _parse_veracity(rows):
+  if len(rows) == 1:
+    row = rows[0]
+    veracity = _str_to_bool(row['veracity'])
+    veracity_score = row['veracity_score'] or 0.0
+    return dict(veracity= veracity, veracity_score= float(veracity_score))
+  else:
+    return dict(veracity= False, veracity_score= 0.0)
+
+def _sdq_counts(rows):
+  # Count of tweets of each sdq_type, from rows with ?sdq_type and ?count
+  v = dict(deny=0, support=0, question=0)
+  for x in rows:
+    if x['sdq_type'] is None:
+      continue
+    v[unicode(x['sdq_type'])] = int(x['count'])
+  return v
+
+def controversiality_score(sdq_counts):
+  # v will hold the count for each sdq_type
+  v = dict(deny=0.0, support=0.0, question=0.0)
+  for (sdq_type, sdq_count) in sdq_counts.iteritems():
+    v[sdq_type] = float(sdq_count)
+  # c holds the sum of the counts
+  c = reduce(lambda c,k: c + v[k], v.keys(), 0.0)
+  # avoid division by 0
+  if c == 0.0:
+    return 0.0
+  elif c < 7.0: # less than 7 tweets means inconclusive result
+    return -0.1
+  else:
+    score = (1.0/3.0) * (
+              pow(v['support'] / c - (1.0/3.0), 2) +
+              pow(v['deny'] / c - (1.0/3.0), 2) +
+              pow(v['question'] / c - (1.0/3.0), 2)
+            )
+    return 1.0 - (9.0/2.0) * score
+
+def _clean_tweet_texts(rows):
+  from collections import OrderedDict
+  return list(OrderedDict.fromkeys(map(lambda x: model.clean_text(unicode(x['text'])), rows)))
+
+def query(query, on_row=None, results_format="json", stats=None, priority=http_clients.INTERACTIVE):
+  """
+  Runs the query and returns the list of result rows (see sparql_results).
+  The results are decoded while they are being received. If on_row is given,
+  rows are passed to it as they are decoded instead of being collected, and
+  the number of rows is returned.
+  results_format selects the format requested from GraphDB ("json" or "tsv").
+  The outcome of the query is recorded in stats (a QueryStats), if given.
+  Queries wait for the adaptive concurrency limit of GraphDB with the given
+  priority (http_clients.INTERACTIVE or BACKGROUND). Identical queries in
+  flight at the same time share their rows, which must not be modified.
+  """
+  if on_row is not None:
+    return _query(query, on_row, results_format, stats, priority)
+  # The same query already in flight (with the same priority, so that an
+  # interactive query doesn't wait behind a background one) shares its rows
+  return http_clients.get_upstream('graphdb').flights.do(
+    ("query", query, results_format, priority),
+    lambda: _query(query, None, results_format, stats, priority))
+
 @gen.coroutine
-def query(query):
-  logger.info("Sending query:\n%s" % query)
+def _query(query, on_row, results_format, stats, priority):
+  logger.debug("Sending query:\n%s" % query)
+  if isinstance(query, unicode):
+    query = query.encode('utf-8')
+  (content_type, format_decoders) = sparql_results.formats[results_format]
+  if GRAPHDB_RESULTS_DECODER not in format_decoders:
+    # the rdflib decoder only supports JSON
+    (content_type, format_decoders) = sparql_results.formats["json"]
+  decoder = format_decoders[GRAPHDB_RESULTS_DECODER]()
+  rows = []
+  state = dict(count=0, bytes=0, error=None)
+  def emit(new_rows):
+    state['count'] += len(new_rows)
+    if on_row is not None:
+      map(on_row, new_rows)
+    else:
+      rows.extend(new_rows)
+  def on_chunk(chunk):
+    state['bytes'] += len(chunk)
+    if state['error'] is not None:
+      return
+    try:
+      emit(decoder.feed(chunk))
+    except Exception as e:
+      state['error'] = e
   r = HTTPRequest(
     GRAPHDB_ENDPOINT,
     method='POST',
     headers={
-      'Accept': 'application/sparql-results+json',
+      'Accept': content_type,
       'Content-Type': 'application/x-www-form-urlencoded'
       },
     body=urllib.urlencode({ 'query': query }),
-    connect_timeout=30,
-    request_timeout=300
+    streaming_callback=on_chunk
     )
-  http_client = AsyncHTTPClient()
-  response = yield http_client.fetch(r)
-  if response.error:
-    raise Exception("Bad GraphDB response " + str(response))
+  limiter = http_clients.get_limiter('graphdb')
+  yield limiter.acquire(priority)
+  t0 = time.time()
+  overloaded = False
+  try:
+    response = yield http_clients.get_upstream('graphdb').fetch(r)
+    if response.error:
+      raise Exception("Bad GraphDB response " + str(response))
+    if state['error'] is not None:
+      raise Exception("Bad GraphDB results: %s" % state['error'])
+    emit(decoder.close())
+  except Exception as e:
+    # timeouts / connection errors (599) and 5xx mean GraphDB is overloaded
+    overloaded = isinstance(e, HTTPError) and e.code >= 500
+    if stats is not None:
+      stats.record(time.time() - t0, state['count'], state['bytes'], error=True)
+    raise
+  finally:
+    limiter.release(t0, overloaded)
+  if stats is not None:
+    stats.record(time.time() - t0, state['count'], state['bytes'])
+  if on_row is not None:
+    raise gen.Return(state['count'])
   else:
-    raise gen.Return(JSONResult(loads(response.body)))
+    raise gen.Return(rows)
+
+# Prepared queries
+#
+# Queries are registered once with prepare(), with a name and their
+# parameters, each with a binder that renders values as SPARQL terms (with
+# the escaping needed). Per query statistics are kept in the registry.
+# Prepared queries run with background priority, unless registered as
+# interactive (those serving API requests).
+
+def _literal(v):
+  v = unicode(v)
+  for (c, e) in [ (u'\\', u'\\\\'), (u'"', u'\\"'), (u'\n', u'\\n'), (u'\r', u'\\r'), (u'\t', u'\\t') ]:
+    v = v.replace(c, e)
+  return u'"%s"' % v
+
+def _datetime(dt):
+  return u'"%s"^^xsd:dateTime' % datetime_to_iso(dt)
+
+def _integer(v):
+  return unicode(int(v))
+
+def _order(v):
+  if v not in [ "ASC", "DESC" ]:
+    raise ValueError("Invalid query order %s" % v)
+  return unicode(v)
+
+_iri_invalid_re = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+
+def _iri(v):
+  v = unicode(v)
+  if _iri_invalid_re.search(v):
+    raise ValueError("Invalid IRI %s" % v)
+  return u'<%s>' % v
+
+def _iri_list(vs):
+  return u" ".join(map(_iri, vs))
+
+def _story_values(stories):
+  # VALUES block binding the event and data channel ids of the given stories
+  return u"VALUES (?eventId ?dataChannelId) { %s }" % u" ".join(
+    map(lambda story: u'(%s %s)' % (_literal(story.event_id), _literal(story.channel_id)), stories))
+
+def _story_since_values(stories_since):
+  # Same as _story_values, from (story, datetime) pairs also binding ?since
+  return u"VALUES (?eventId ?dataChannelId ?since) { %s }" % u" ".join(
+    map(lambda (story, since): u'(%s %s %s)' % (_literal(story.event_id), _literal(story.channel_id), _datetime(since)), stories_since))
+
+class QueryStats(object):
+  # Upper bounds of the latency histogram buckets, in seconds
+  latency_buckets = [ 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300 ]
+
+  def __init__(self):
+    self.calls = 0
+    self.errors = 0
+    self.rows = 0
+    self.bytes = 0
+    self.time = 0.0
+    self.max_time = 0.0
+    self.latency = [ 0 ] * (len(self.latency_buckets) + 1)   # last one is +inf
+
+  def record(self, t, rows, nbytes, error=False):
+    self.calls += 1
+    self.errors += 1 if error else 0
+    self.rows += rows
+    self.bytes += nbytes
+    self.time += t
+    self.max_time = max(self.max_time, t)
+    i = 0
+    while i < len(self.latency_buckets) and t > self.latency_buckets[i]:
+      i += 1
+    self.latency[i] += 1
+
+  def obj(self):
+    return dict(
+      calls= self.calls,
+      errors= self.errors,
+      rows= self.rows,
+      bytes= self.bytes,
+      avg_time= self.time / self.calls if self.calls > 0 else 0.0,
+      max_time= self.max_time,
+      latency= dict(zip(map(lambda b: "le_%s" % b, self.latency_buckets) + [ "le_inf" ], self.latency)),
+      )
+
+class PreparedQuery(object):
+  """
+  A named query template. The template is parsed once into its literal
+  parts and parameters, and $pheme_versions is resolved at that point.
+  """
+  def __init__(self, name, text, results_format="json", priority=http_clients.BACKGROUND, **binders):
+    self.name = name
+    self.results_format = results_format
+    self.priority = priority
+    self.binders = binders
+    self.stats = QueryStats()
+    # split into literal text (even positions) and parameter names (odd)
+    self.parts = []
+    literal = []
+    pos = 0
+    for m in Template.pattern.finditer(text):
+      literal.append(text[pos:m.start()])
+      pos = m.end()
+      param = m.group('named') or m.group('braced')
+      if m.group('escaped') is not None:
+        literal.append('$')
+      elif param == 'pheme_versions':
+        literal.append(_graphdb_pheme_versions)
+      elif param in binders:
+        self.parts += [ "".join(literal), param ]
+        literal = []
+      else:
+        raise Exception("Query %s: unknown parameter at %s" % (name, text[m.start():m.start()+20]))
+    literal.append(text[pos:])
+    self.parts.append("".join(literal))
+    missing = set(binders.keys()) - set(self.parts[1::2])
+    if missing:
+      raise Exception("Query %s: parameters %s not in template" % (name, ", ".join(missing)))
+
+  def bind(self, **params):
+    bound = list(self.parts)
+    for i in range(1, len(bound), 2):
+      bound[i] = self.binders[bound[i]](params[bound[i]])
+    return u"".join(bound)
+
+  @gen.coroutine
+  def run(self, on_row=None, **params):
+    logger.info("Sending query %s (%s)" % (self.name, _params_summary(params)))
+    result = yield query(self.bind(**params), on_row=on_row, results_format=self.results_format, stats=self.stats, priority=self.priority)
+    raise gen.Return(result)
+
+def _params_summary(params):
+  def summary(v):
+    if isinstance(v, (list, tuple)):
+      return "<%d values>" % len(v)
+    return unicode(v)
+  return ", ".join(map(lambda k: "%s=%s" % (k, summary(params[k])), sorted(params.keys())))
+
+_prepared = OrderedDict()   # name -> PreparedQuery
+
+def prepare(name, text, results_format="json", priority=http_clients.BACKGROUND, **binders):
+  if name in _prepared:
+    raise Exception("Query %s is already registered" % name)
+  q = PreparedQuery(name, text, results_format=results_format, priority=priority, **binders)
+  _prepared[name] = q
+  return q
+
+def query_stats():
+  return OrderedDict(map(lambda q: (q.name, q.stats.obj()), _prepared.values()))
+
+class ResultCache(object):
+  """
+  LRU cache of story query results, keyed by (template name, parameters).
+  Each entry records the last_activity watermark of the story it was obtained
+  for, and is only valid for lookups with that same watermark: once the story
+  has received new activity, its cached results are dropped. Entries are
+  evicted in LRU order to keep the (pickled) size of the values within
+  max_bytes.
+  """
+  def __init__(self, max_bytes):
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()   # key -> (watermark, value, size)
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.invalidations = 0
+    self.evictions = 0
+
+  def lookup(self, key, watermark):
+    # Returns (found, value)
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      self.misses += 1
+      return (False, None)
+    if entry[0] != watermark:
+      self.bytes -= entry[2]
+      self.invalidations += 1
+      self.misses += 1
+      return (False, None)
+    self.entries[key] = entry
+    self.hits += 1
+    return (True, entry[1])
+
+  def put(self, key, watermark, value):
+    size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+    if size > self.max_bytes:
+      return
+    old = self.entries.pop(key, None)
+    if old is not None:
+      self.bytes -= old[2]
+    self.entries[key] = (watermark, value, size)
+    self.bytes += size
+    while self.bytes > self.max_bytes:
+      (_, (_, _, evicted_size)) = self.entries.popitem(last=False)
+      self.bytes -= evicted_size
+      self.evictions += 1
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return dict(
+      entries= len(self.entries),
+      bytes= self.bytes,
+      hits= self.hits,
+      misses= self.misses,
+      hit_rate= float(self.hits) / lookups if lookups > 0 else 0.0,
+      invalidations= self.invalidations,
+      evictions= self.evictions,
+      )
+
+_result_cache = ResultCache(GRAPHDB_RESULT_CACHE_BYTES)
+
+def _story_watermark(story):
+  # (parameters, watermark) for a graphdb / ush_v3 story object
+  return ((story.channel_id, story.event_id), getattr(story, 'last_activity', None))
+
+def _story_dict_watermark(story):
+  # (parameters, watermark) for a story in dict form
+  return ((story['channel_id'], story['event_id']), story.get('last_activity'))
+
+def _cached(name, watermark_of):
+  """
+  Caches the results of a story query coroutine in _result_cache. Results are
+  only cached for stories with a known last_activity.
+  """
+  def decorator(f):
+    @functools.wraps(f)
+    @gen.coroutine
+    def wrapper(story):
+      (params, watermark) = watermark_of(story)
+      if watermark is None:
+        result = yield f(story)
+        raise gen.Return(result)
+      key = (name, params)
+      (found, result) = _result_cache.lookup(key, watermark)
+      if not found:
+        result = yield f(story)
+        _result_cache.put(key, watermark, result)
+      raise gen.Return(result)
+    return wrapper
+  return decorator
+
+def result_cache_stats():
+  return _result_cache.stats()
 
 import model
 
 class Story(model.Story):   # aka Theme / Pheme
-  @staticmethod
-  @gen.coroutine
-  def fetch_updated_since(channel, since=None, limit=100, order="ASC"):
-    # Query graphdb for latest events belonging to the given channel
-    q = Template("""
+  _updated_since_query = prepare("updated_since", """
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       SELECT ?eventId ?sourceType (MAX(?date) AS ?lastUpdate)
       WHERE {
           ?a a pheme:Tweet .
           ?a pheme:sourceType ?sourceType.
           ?a pheme:createdAt ?date.
-          FILTER (?date >= "$since_date"^^xsd:dateTime).
+          FILTER (?date >= $since_date).
           ?a pheme:eventId ?eventId.
           FILTER (xsd:integer(?eventId) > -1).
-          ?a pheme:dataChannel "$data_channel_id".
+          ?a pheme:dataChannel $data_channel_id.
           ?a pheme:version ?pheme_version.
           FILTER ( ?pheme_version IN $pheme_versions ).
       } GROUP BY ?eventId ?sourceType
       ORDER BY $order(?lastUpdate)
       LIMIT $limit
-    """).substitute(
-      data_channel_id=channel._id,
-      since_date=datetime_to_iso(since),
-      pheme_versions=_graphdb_pheme_versions,
-      order=order,
-      limit=limit)
-    result = yield query(q)
+    """,
+    data_channel_id=_literal, since_date=_datetime, order=_order, limit=_integer)
+
+  @staticmethod
+  @gen.coroutine
+  def fetch_updated_since(channel, since=None, limit=100, order="ASC"):
+    # Query graphdb for latest events belonging to the given channel
+    result = yield Story._updated_since_query.run(data_channel_id=channel._id, since_date=since, order=order, limit=limit)
     result = filter(lambda x: x['eventId'] is not None, result)
     stories = map(lambda x:
                    Story(channel_id=channel._id,
-                         event_id=x['eventId'].decode(),
-                         source_type=x['sourceType'].decode().lower(),
-                         last_activity=iso8601.parse_date(x['lastUpdate'].decode()),
+                         event_id=unicode(x['eventId']),
+                         source_type=unicode(x['sourceType']).lower(),
+                         last_activity=_to_datetime(x['lastUpdate']),
                          ), result)
     raise gen.Return(stories)
 
-  @gen.coroutine
-  def get_latest_title(self):
-    q = Template("""
-      PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
-      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-      SELECT ?phemeTitle 
-      WHERE {
-        ?a pheme:createdAt ?date.
-        ?a pheme:eventId "$event_id" .
-        ?a pheme:dataChannel "$data_channel_id".
-        ?a pheme:version ?pheme_version.
-        ?a pheme:eventClusterTitle ?phemeTitle.
-        FILTER ( ?pheme_version IN $pheme_versions ).
-      } 
-      ORDER BY DESC(?date)
-      LIMIT 1
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-    assert len(result) == 1
-
-    x = iter(result).next()
-    raise gen.Return(unicode(x['phemeTitle']))
-
-  @gen.coroutine
-  def get_extended_metadata(self):
-    q = Template("""
-      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
-      PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
-      PREFIX sioc: <http://rdfs.org/sioc/ns#>
-
-      select (sum(xsd:integer(xsd:boolean(?verified))) as ?verified_count) 
-             (count(distinct ?imageURL) as ?img_count) 
-             (count(distinct ?URL) as ?pub_count)
-             (count(?a) as ?size)
-             (MIN(?date) as ?start_date)
-      where {   
-        ?a a pheme:Tweet .
-        ?a pheme:createdAt ?date.        
-        ?a pheme:eventId "$event_id" .
-        ?a pheme:version ?pheme_version.
-        FILTER ( ?pheme_version IN $pheme_versions ).
-        ?a pheme:dataChannel "$data_channel_id".
-        OPTIONAL {?a pheme:hasEvidentialityPicture ?imageURL} .
-        OPTIONAL {?a pheme:hasEvidentialityUrl ?URL} .
-        ?a sioc:has_creator ?user .
-        ?user pheme:twitterUserVerified ?verified .  
-      }
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-    assert len(result) == 1
-
-    x = iter(result).next()
-    raise gen.Return(dict(
-      size= int(x['size'].decode()),
-      start_date= iso8601.parse_date(x['start_date'].decode()),
-      verified_count= int(x['verified_count'].decode()),
-      img_count= int(x['img_count'].decode()),
-      pub_count = int(x['pub_count'].decode())
-    ))
-
-  @gen.coroutine
-  def get_featured_tweet(self):
-    # Grab featured tweet in Theme
-    # (currently, the oldest)
-    q = Template("""
-      PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
-      PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
-      PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
-      PREFIX sioc: <http://rdfs.org/sioc/ns#>
-      PREFIX foaf: <http://xmlns.com/foaf/0.1/>
-      PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-
-      select ?thread ?source ?sourceType ?text ?userName ?userHandle ?verified ?date (count(?a) as ?countReplies) ?avatar where {   
-        ?a a pheme:ReplyingTweet .
-        ?a pheme:sourceType ?sourceType .
-        ?source a pheme:SourceTweet.
-        ?source sioc:has_container ?thread.
-        ?source sioc:has_creator ?creator.
-        ?creator foaf:name ?userName.
-        ?creator foaf:accountName ?userHandle.
-        OPTIONAL { ?creator foaf:depiction ?avatar. }
-        ?creator pheme:twitterFollowersCount ?numberOfFollowers .
-        ?creator pheme:twitterUserVerified ?verified .
-        ?source pheme:createdAt ?date.
-        ?source dlpo:textualContent ?text.
-        ?a sioc:has_container ?thread.
-        ?a pheme:eventId "$event_id".
-        ?a pheme:dataChannel "$data_channel_id".
-        ?a pheme:version ?pheme_version.
-        FILTER ( ?pheme_version IN $pheme_versions ).
-      } GROUP BY ?thread ?source ?sourceType ?text ?userName ?userHandle ?verified ?date ?avatar
-      order by desc(?countReplies)
-      limit 1
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-    assert len(result) == 1   # Because of grouping, there must always be a result row
-
-    # If there were no real results from the query, try an alternative one
-    x = iter(result).next()
-    if x['text'] is None:
-      logger.info("No replies / retweets in cluster, using alternative query")
-      x = yield self._get_featured_tweet_alt()
-    #
-    source_type = x['sourceType'].decode()
-    # Decode source to tweet id
-    if source_type.lower() == 'twitter':
-      tweet_id = re.match(r'.*\D(\d+)$', x['source'].decode())
-      if tweet_id is None:
-        raise Exception("Unparseable tweet_id from result %s" % str(x))
-      else:
-        tweet_id = tweet_id.groups()[0]
-    else:
-      tweet_id = "#%s-noid" % source_type
-    # Use results
-    if x is not None and x['text'] is not None:
-      logger.info("Representative tweet: " + str(x))
-      raise gen.Return(dict(
-        tweet_id= tweet_id,
-        text= unicode(x['text']),
-        date= iso8601.parse_date(x['date'].decode()),
-        user= dict(
-          profile_image_url = _avatar_process(x['avatar']),
-          user_description= x['userName'],
-          user_screen_name= x['userHandle']),
-          is_verified = (x['verified'].capitalize() == 'True')
-        ))
-
-  @gen.coroutine
-  def get_linked_images(self):
-    q = Template("""
+  _linked_images_query = prepare("linked_images", """
       PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
@@ -236,24 +502,23 @@ class Story(model.Story):   # aka Theme / Pheme
       select (MIN(?cDate) as ?date) ?imageURL (count(?imageURL) as ?countImage) where {   
           ?a pheme:createdAt ?cDate .
           ?a pheme:hasEvidentialityPicture ?imageURL .
-          ?a pheme:eventId "$event_id".
-          ?a pheme:dataChannel "$data_channel_id".
+          ?a pheme:eventId $event_id.
+          ?a pheme:dataChannel $data_channel_id.
           ?a pheme:version ?pheme_version.
           FILTER ( ?pheme_version IN $pheme_versions ).
       } group by ?imageURL
       having (?countImage > 0)
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-
-    raise gen.Return(map(lambda x: dict(
-                          date= iso8601.parse_date(x['date'].decode()),
-                          imgUrl= x['imageURL'].decode(),
-                          count= int(x['countImage'].decode())),
-                         result))
+    """, priority=http_clients.INTERACTIVE,
+    event_id=_literal, data_channel_id=_literal)
 
+  @_cached("linked_images", _story_watermark)
   @gen.coroutine
-  def get_related_articles(self):
-    q = Template("""
+  def get_linked_images(self):
+    result = yield Story._linked_images_query.run(event_id=self.event_id, data_channel_id=self.channel_id)
+
+    raise gen.Return(map(_parse_linked_image, result))
+
+  _related_articles_query = prepare("related_articles", """
       PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
@@ -265,40 +530,51 @@ class Story(model.Story):   # aka Theme / Pheme
           ?a sioc:has_container ?thread .
           ?a pheme:hasEvidentialityUrl ?URL .
           ?a dlpo:textualContent ?text.
-          ?a pheme:eventId "$event_id".
-          ?a pheme:dataChannel "$data_channel_id".
+          ?a pheme:eventId $event_id.
+          ?a pheme:dataChannel $data_channel_id.
           ?a pheme:version ?pheme_version.
           FILTER ( ?pheme_version IN $pheme_versions ).
       } order by desc(?date)
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
+    """, results_format="tsv", priority=http_clients.INTERACTIVE,
+    event_id=_literal, data_channel_id=_literal)
+
+  @_cached("related_articles", _story_watermark)
+  @gen.coroutine
+  def _get_related_articles(self):
+    result = yield Story._related_articles_query.run(event_id=self.event_id, data_channel_id=self.channel_id)
 
-    articles = map(lambda x: dict(
-                          date= iso8601.parse_date(x['date'].decode()),
+    raise gen.Return(map(lambda x: dict(
+                          date= _to_datetime(x['date']),
                           text= unicode(x['text']),
-                          thread= x['thread'].decode(),
-                          url= x['URL'].decode()),
-                         result)
+                          thread= unicode(x['thread']),
+                          url= unicode(x['URL'])),
+                         result))
+
+  @gen.coroutine
+  def get_related_articles(self):
+    # The urls are canonicalised on each call (from the url cache), those
+    # that take too long are returned as they are this time
+    articles = yield self._get_related_articles()
 
     logger.info("- canonicalising %d URLs" % len(articles))
 
-    from url_utils import get_canonical_url
+    from url_utils import get_canonical_urls
     from urlparse import urlparse
+    canonical_urls = yield get_canonical_urls(map(lambda art: art['url'], articles))
+    ret = []
     for art in articles:
-      canonical_url = yield get_canonical_url(art['url'])
+      canonical_url = canonical_urls[art['url']]
       canonical_url_p = urlparse(canonical_url)
-      art['canonicalUrl'] = {
+      ret.append(dict(art, canonicalUrl= {
         "url": canonical_url,
         "scheme": canonical_url_p.scheme,
         "netloc": canonical_url_p.netloc,
         "path": canonical_url_p.path
-      }
+      }))
 
-    raise gen.Return(articles)
+    raise gen.Return(ret)
 
-  @gen.coroutine
-  def get_author_locations(self):
-    q = Template("""
+  _author_locations_query = prepare("author_locations", """
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       PREFIX pub: <http://ontology.ontotext.com/taxonomy/>
       PREFIX wgs84_pos: <http://www.w3.org/2003/01/geo/wgs84_pos#>
@@ -312,8 +588,8 @@ class Story(model.Story):   # aka Theme / Pheme
           FILTER ( ?pheme_version IN $pheme_versions ).
           ?t pheme:createdAt ?date .
           ?t pheme:userLocations ?loc.
-          ?t pheme:dataChannel "$data_channel_id".
-          ?t pheme:eventId "$event_id" .
+          ?t pheme:dataChannel $data_channel_id.
+          ?t pheme:eventId $event_id .
           ?t dlpo:\#textualContent ?text.
           ?loc pheme:inst ?location.
           ?location a pub:Location.
@@ -325,12 +601,17 @@ class Story(model.Story):   # aka Theme / Pheme
           ?u foaf:accountName ?userHandle.
       }
       LIMIT 100
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
+    """, priority=http_clients.INTERACTIVE,
+    event_id=_literal, data_channel_id=_literal)
+
+  @_cached("author_locations", _story_watermark)
+  @gen.coroutine
+  def get_author_locations(self):
+    result = yield Story._author_locations_query.run(event_id=self.event_id, data_channel_id=self.channel_id)
 
     locations = map(lambda x: dict(
                             userHandle= unicode(x['userHandle']),
-                            date= iso8601.parse_date(x['date'].decode()),
+                            date= _to_datetime(x['date']),
                             lat= float(x['lat']),
                             long= float(x['long']),
                             text= unicode(x['text'])),
@@ -338,138 +619,383 @@ class Story(model.Story):   # aka Theme / Pheme
 
     raise gen.Return(locations)
 
+  _aggregates_many_query = prepare("aggregates_many", """
+      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+      PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
+      PREFIX sioc: <http://rdfs.org/sioc/ns#>
+
+      select * {
+        {
+          {
+            select ?eventId ?dataChannelId
+                   (count(?a) as ?size)
+                   (sum(xsd:integer(xsd:boolean(?verified))) as ?verified_count)
+                   (MIN(?date) as ?start_date)
+                   (MAX(?date) as ?until) {
+              $values
+              ?a a pheme:Tweet .
+              ?a pheme:createdAt ?date.
+              FILTER ( ?date > ?since ).
+              ?a pheme:eventId ?eventId .
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+              ?a sioc:has_creator ?user .
+              ?user pheme:twitterUserVerified ?verified .
+            } group by ?eventId ?dataChannelId
+          }
+          BIND ("counts" AS ?part)
+        } UNION {
+          {
+            select distinct ?eventId ?dataChannelId ?imageURL {
+              $values
+              ?a pheme:createdAt ?date.
+              FILTER ( ?date > ?since ).
+              ?a pheme:hasEvidentialityPicture ?imageURL .
+              ?a pheme:eventId ?eventId.
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            }
+          }
+          BIND ("image" AS ?part)
+        } UNION {
+          {
+            select distinct ?eventId ?dataChannelId ?URL {
+              $values
+              ?a pheme:createdAt ?date.
+              FILTER ( ?date > ?since ).
+              ?a pheme:hasEvidentialityUrl ?URL .
+              ?a pheme:eventId ?eventId.
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            }
+          }
+          BIND ("url" AS ?part)
+        } UNION {
+          {
+            select ?eventId ?dataChannelId ?sdq_type (count(?sdq_type) as ?count) {
+              $values
+              ?a a pheme:Tweet .
+              ?a pheme:createdAt ?date.
+              FILTER ( ?date > ?since ).
+              ?a pheme:eventId ?eventId.
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:sdq ?sdq_type .
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            } group by ?eventId ?dataChannelId ?sdq_type
+          }
+          BIND ("sdq" AS ?part)
+        }
+      }
+    """, results_format="tsv",
+    values=_story_since_values)
+
+  @staticmethod
   @gen.coroutine
-  def _get_featured_tweet_alt(self):
-    # Just retrieve the oldest tweet from an event
-    q = Template("""
+  def fetch_aggregates_many(stories, since={}):
+    """
+    Counters of the tweets of the given stories created after since (story id
+    -> datetime, from the beginning if missing or None), in a single query.
+    Returns a dict of story id -> dict(size, verified_count, start_date, until,
+    images, urls, sdq), where images and urls are sets of the distinct URLs,
+    sdq is a dict of sdq_type -> count and until is the creation date of the
+    latest tweet counted. Stories without such tweets are left out. Counters
+    from consecutive periods add up to those of the whole story, except for
+    the distinct URLs, which have to be merged as sets.
+    """
+    if len(stories) == 0:
+      raise gen.Return({})
+    result = yield Story._aggregates_many_query.run(
+      values=map(lambda story: (story, since.get(story._id)), stories))
+
+    ret = {}
+    for (story_id, rows) in _rows_by_story(result).iteritems():
+      parts = dict(counts=[], image=[], url=[], sdq=[])
+      for x in rows:
+        parts[unicode(x['part'])].append(x)
+      if len(parts['counts']) == 0:
+        continue
+      x = parts['counts'][0]
+      ret[story_id] = dict(
+        size= int(x['size']),
+        verified_count= int(x['verified_count']),
+        start_date= _to_datetime(x['start_date']),
+        until= _to_datetime(x['until']),
+        images= set(map(lambda x: unicode(x['imageURL']), parts['image'])),
+        urls= set(map(lambda x: unicode(x['URL']), parts['url'])),
+        sdq= _sdq_counts(parts['sdq'])
+      )
+    raise gen.Return(ret)
+
+  _snapshot_many_query = prepare("snapshot_many", """
       PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
       PREFIX sioc: <http://rdfs.org/sioc/ns#>
       PREFIX foaf: <http://xmlns.com/foaf/0.1/>
+      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
 
-      select (?a AS ?source) ?sourceType ?text ?date ?userName ?userHandle ?avatar ?verified
-      where {
-        ?a pheme:sourceType ?sourceType .
-        ?a pheme:eventId "$event_id".
-        ?a pheme:dataChannel "$data_channel_id".
-        ?a pheme:createdAt ?date.
-        ?a dlpo:textualContent ?text.
-        ?a sioc:has_creator ?u.
-        ?u foaf:name ?userName.
-        ?u foaf:accountName ?userHandle.
-        OPTIONAL { ?u foaf:depiction ?avatar. }
-        ?u pheme:twitterFollowersCount ?numberOfFollowers .
-        ?u pheme:twitterUserVerified ?verified .
-        ?a pheme:version ?pheme_version.
-        FILTER ( ?pheme_version IN $pheme_versions ).
+      select * {
+        {
+          {
+            select ?eventId ?dataChannelId (MAX(?date) AS ?titleDate) {
+              $values
+              ?a pheme:createdAt ?date.
+              ?a pheme:eventId ?eventId .
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:version ?pheme_version.
+              ?a pheme:eventClusterTitle ?anyTitle.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            } group by ?eventId ?dataChannelId
+          }
+          ?t pheme:createdAt ?titleDate.
+          ?t pheme:eventId ?eventId .
+          ?t pheme:dataChannel ?dataChannelId.
+          ?t pheme:version ?title_pheme_version.
+          ?t pheme:eventClusterTitle ?phemeTitle.
+          FILTER ( ?title_pheme_version IN $pheme_versions ).
+          BIND ("title" AS ?part)
+        } UNION {
+          {
+            select ?eventId ?dataChannelId ?source (count(?a) as ?countReplies) {
+              $values
+              ?a a pheme:ReplyingTweet .
+              ?a sioc:has_container ?thread.
+              ?source a pheme:SourceTweet.
+              ?source sioc:has_container ?thread.
+              ?a pheme:eventId ?eventId.
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            } group by ?eventId ?dataChannelId ?source
+          }
+          BIND ("featured" AS ?part)
+        } UNION {
+          {
+            select ?eventId ?dataChannelId (MIN(?cDate) as ?date) ?imageURL (count(?imageURL) as ?countImage) {
+              $values
+              ?a pheme:createdAt ?cDate .
+              ?a pheme:hasEvidentialityPicture ?imageURL .
+              ?a pheme:eventId ?eventId.
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            } group by ?eventId ?dataChannelId ?imageURL
+            having (?countImage > 0)
+          }
+          BIND ("image" AS ?part)
+        } UNION {
+          {
+            select ?eventId ?dataChannelId (MAX(?date) AS ?veracityDate) {
+              $values
+              ?tweet a pheme:Tweet .
+              ?tweet pheme:eventId ?eventId.
+              ?tweet pheme:dataChannel ?dataChannelId.
+              ?tweet pheme:createdAt ?date .
+              ?tweet pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+              ?tweet pheme:veracity ?anyVeracity .
+              ?tweet pheme:veracityScore ?anyVeracityScore .
+            } group by ?eventId ?dataChannelId
+          }
+          ?v a pheme:Tweet .
+          ?v pheme:eventId ?eventId.
+          ?v pheme:dataChannel ?dataChannelId.
+          ?v pheme:createdAt ?veracityDate .
+          ?v pheme:version ?veracity_pheme_version.
+          FILTER ( ?veracity_pheme_version IN $pheme_versions ).
+          ?v pheme:veracity ?veracity .
+          ?v pheme:veracityScore ?veracity_score .
+          BIND ("veracity" AS ?part)
+        } UNION {
+          {
+            select ?eventId ?dataChannelId ?a ?text ?textDate {
+              $text_values
+              ?a a pheme:Tweet .
+              ?a pheme:eventId ?eventId.
+              ?a pheme:dataChannel ?dataChannelId.
+              ?a dlpo:textualContent ?text.
+              ?a pheme:createdAt ?textDate.
+              FILTER ( ?textDate >= ?since ).
+              ?a pheme:version ?pheme_version.
+              FILTER ( ?pheme_version IN $pheme_versions ).
+            }
+          }
+          BIND ("text" AS ?part)
+        }
       }
-      order by DESC(?verified) DESC(?numberOfFollowers) ?date
-      limit 1
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-    if len(result) == 1:
-      tweet = iter(result).next()
-      raise gen.Return(tweet)
+    """, results_format="tsv",
+    values=_story_values, text_values=_story_since_values)
 
+  @staticmethod
   @gen.coroutine
-  def get_controversiality_score(self):
-    #
-    q = Template("""
-      PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
-      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
+  def fetch_snapshot_many(stories, texts_since={}):
+    """
+    Fetch in a single query, for all the given stories, their latest title,
+    linked images, last veracity and tweet texts, plus the candidate source
+    tweets for the featured tweet. Each of those is a
+    branch of a UNION tagged with ?part, and the stories are bound with a
+    VALUES block. The details of the featured tweets are fetched with a second
+    query, and those of the stories without replies with a third one. Returns
+    a dict of story id -> snapshot dict. The counters of the story (size,
+    controversiality...) are not part of the snapshot, see
+    fetch_aggregates_many.
+    texts_since (story id -> datetime) restricts the tweet texts of a story to
+    those created since then; the latest creation date of the texts returned
+    is in the tweet_texts_until field of the snapshot.
+    """
+    if len(stories) == 0:
+      raise gen.Return({})
+    result = yield Story._snapshot_many_query.run(values=stories,
+      text_values=map(lambda story: (story, texts_since.get(story._id)), stories))
 
-      select ?sdq_type (count(?sdq_type) as ?count) where {
-        ?a a pheme:Tweet .
-        ?a pheme:eventId "$event_id".
-        ?a pheme:dataChannel "$data_channel_id".
-        ?a pheme:sdq ?sdq_type .
-        ?a pheme:version ?pheme_version.
-        FILTER ( ?pheme_version IN $pheme_versions ).
-      } group by ?sdq_type
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
+    # Split the rows per story and part
+    parts = {}
+    for (story_id, rows) in _rows_by_story(result).iteritems():
+      parts[story_id] = dict(title=[], featured=[], image=[], veracity=[], text=[])
+      for x in rows:
+        parts[story_id][unicode(x['part'])].append(x)
 
-    # v will hold the count for each sdq_type
-    v = dict(deny=0.0, support=0.0, question=0.0)
-    for x in result:
-      if x['sdq_type'] is None:
+    # The featured tweet is the source tweet with most replies
+    featured_sources = {}
+    for (story_id, p) in parts.iteritems():
+      if len(p['featured']) > 0:
+        x = max(p['featured'], key=lambda x: int(x['countReplies']))
+        featured_sources[story_id] = unicode(x['source'])
+    featured_details = yield Story._fetch_featured_details_many(featured_sources.values())
+
+    # If there were no replies in the cluster, use the alternative query (all
+    # the stories in need of it at once)
+    found = filter(lambda story: story._id in parts and len(parts[story._id]['title']) > 0, stories)
+    featured = {}
+    for story in found:
+      x = featured_details.get(featured_sources.get(story._id))
+      if x is not None and x['text'] is not None:
+        featured[story._id] = x
+    alt_stories = filter(lambda story: story._id not in featured, found)
+    if len(alt_stories) > 0:
+      logger.info("No replies / retweets in %d clusters, using alternative query" % len(alt_stories))
+      featured.update((yield Story._fetch_featured_tweet_alt_many(alt_stories)))
+
+    ret = {}
+    for story in stories:
+      if story._id not in parts or len(parts[story._id]['title']) == 0:
+        logger.info("No snapshot data for story %s" % story._id)
         continue
-      sdq_type = x['sdq_type'].decode()
-      sdq_count = int(x['count'].decode())
-      v[sdq_type] = float(sdq_count)
-    # c holds the sum of the counts
-    c = reduce(lambda c,k: c + v[k], v.keys(), 0.0)
-    # avoid division by 0
-    if c == 0.0:
-      raise gen.Return(0.0)
-    elif c < 7.0: # less than 7 tweets means inconclusive result
-      raise gen.Return(-0.1)
-    else:
-      score = (1.0/3.0) * (
-                pow(v['support'] / c - (1.0/3.0), 2) +
-                pow(v['deny'] / c - (1.0/3.0), 2) +
-                pow(v['question'] / c - (1.0/3.0), 2)
-              )
-      raise gen.Return(1.0 - (9.0/2.0) * score)
+      p = parts[story._id]
+      x = featured.get(story._id)
+      featured_tweet = None
+      if x is not None and x['text'] is not None:
+        featured_tweet = _parse_featured_tweet(x)
+      #
+      ret[story._id] = dict(
+        title= unicode(p['title'][0]['phemeTitle']),
+        featured_tweet= featured_tweet,
+        images= map(_parse_linked_image, p['image']),
+        veracity= _parse_veracity(p['veracity'][:1]),
+        tweet_texts= _clean_tweet_texts(p['text']),
+        tweet_texts_until= max(map(lambda x: _to_datetime(x['textDate']), p['text'])) if len(p['text']) > 0 else None
+      )
+    raise gen.Return(ret)
 
-  @gen.coroutine
-  def get_tweet_texts(self):
-    def clean_list(texts):
-      from collections import OrderedDict
-      return list(OrderedDict.fromkeys(texts))
-    #
-    q = Template("""
+  _featured_details_many_query = prepare("featured_details_many", """
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
-      PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
       PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
+      PREFIX sioc: <http://rdfs.org/sioc/ns#>
+      PREFIX foaf: <http://xmlns.com/foaf/0.1/>
 
-      select ?a ?text {
-        ?a a pheme:Tweet .
-        ?a pheme:eventId "$event_id".
-        ?a pheme:dataChannel "$data_channel_id".
-        ?a dlpo:textualContent ?text.
-        ?a pheme:version ?pheme_version.
-        FILTER ( ?pheme_version IN $pheme_versions ).
+      select ?thread ?source ?sourceType ?text ?userName ?userHandle ?verified ?date ?avatar where {
+        VALUES ?source { $sources }
+        ?source pheme:sourceType ?sourceType .
+        ?source sioc:has_container ?thread.
+        ?source sioc:has_creator ?creator.
+        ?creator foaf:name ?userName.
+        ?creator foaf:accountName ?userHandle.
+        OPTIONAL { ?creator foaf:depiction ?avatar. }
+        ?creator pheme:twitterFollowersCount ?numberOfFollowers .
+        ?creator pheme:twitterUserVerified ?verified .
+        ?source pheme:createdAt ?date.
+        ?source dlpo:textualContent ?text.
       }
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-
-    texts = clean_list(map(lambda x: model.clean_text(unicode(x['text'])), result))
-    raise gen.Return(texts)
+    """,
+    sources=_iri_list)
 
+  @staticmethod
   @gen.coroutine
-  def get_last_veracity(self):
-    q = Template("""
-      PREFIX sioc: <http://rdfs.org/sioc/ns#>
+  def _fetch_featured_details_many(sources):
+    # Details of the given source tweets, as a dict of source uri -> row
+    # with ?source, ?sourceType, ?text, ?date, ?userName, ?userHandle,
+    # ?avatar and ?verified
+    if len(sources) == 0:
+      raise gen.Return({})
+    result = yield Story._featured_details_many_query.run(sources=sources)
+
+    ret = {}
+    for x in result:
+      ret.setdefault(unicode(x['source']), x)
+    raise gen.Return(ret)
+
+  _featured_tweet_alt_many_query = prepare("featured_tweet_alt_many", """
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
+      PREFIX sioc: <http://rdfs.org/sioc/ns#>
       PREFIX foaf: <http://xmlns.com/foaf/0.1/>
       PREFIX xsd: <http://www.w3.org/2001/XMLSchema#>
 
-      select ?veracity ?veracity_score
+      select ?eventId ?dataChannelId (?a AS ?source) ?sourceType ?text ?date ?userName ?userHandle ?avatar ?verified {
         {
-        ?tweet a pheme:Tweet .
-        ?tweet pheme:eventId "$event_id".
-        ?tweet pheme:dataChannel "$data_channel_id".
-        ?tweet pheme:createdAt ?date .
-        ?tweet pheme:version ?pheme_version.
-        FILTER ( ?pheme_version IN $pheme_versions ).
-        ?tweet pheme:veracity ?veracity .
-        ?tweet pheme:veracityScore ?veracity_score .
+          select ?eventId ?dataChannelId (MAX(?rank) AS ?bestRank) {
+            $values
+            ?a pheme:eventId ?eventId.
+            ?a pheme:dataChannel ?dataChannelId.
+            ?a pheme:sourceType ?anySourceType .
+            ?a pheme:createdAt ?anyDate.
+            ?a dlpo:textualContent ?anyText.
+            ?a sioc:has_creator ?u.
+            ?u foaf:name ?anyUserName.
+            ?u foaf:accountName ?anyUserHandle.
+            ?u pheme:twitterFollowersCount ?numberOfFollowers .
+            ?u pheme:twitterUserVerified ?verified .
+            ?a pheme:version ?pheme_version.
+            FILTER ( ?pheme_version IN $pheme_versions ).
+            BIND ((IF(STR(?verified) = "true", 1000000000000, 0) + xsd:integer(?numberOfFollowers)) AS ?rank)
+          } group by ?eventId ?dataChannelId
         }
-        order by DESC(?date)
-        limit 1
-    """).substitute(event_id=self.event_id, data_channel_id=self.channel_id, pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
-
-    if len(result) == 1:
-      row = iter(result).next()
-      veracity = _str_to_bool(row['veracity'])
-      veracity_score = row['veracity_score'] or 0.0
-      ret = dict(veracity= veracity, veracity_score= float(veracity_score))
-    else:
-      ret = dict(veracity= False, veracity_score= 0.0)
+        ?a pheme:eventId ?eventId.
+        ?a pheme:dataChannel ?dataChannelId.
+        ?a pheme:sourceType ?sourceType .
+        ?a pheme:createdAt ?date.
+        ?a dlpo:textualContent ?text.
+        ?a sioc:has_creator ?u.
+        ?u foaf:name ?userName.
+        ?u foaf:accountName ?userHandle.
+        OPTIONAL { ?u foaf:depiction ?avatar. }
+        ?u pheme:twitterFollowersCount ?numberOfFollowers .
+        ?u pheme:twitterUserVerified ?verified .
+        ?a pheme:version ?pheme_version.
+        FILTER ( ?pheme_version IN $pheme_versions ).
+        FILTER ( (IF(STR(?verified) = "true", 1000000000000, 0) + xsd:integer(?numberOfFollowers)) = ?bestRank ).
+      }
+    """,
+    values=_story_values)
+
+  @staticmethod
+  @gen.coroutine
+  def _fetch_featured_tweet_alt_many(stories):
+    # The featured tweet of each of the given stories without replies, as a
+    # dict of story id -> row (with the same fields as the featured details
+    # above): the oldest tweet of the top ranked author (by verified, then
+    # followers). The author is picked in the query, the tweet here.
+    if len(stories) == 0:
+      raise gen.Return({})
+    result = yield Story._featured_tweet_alt_many_query.run(values=stories)
+
+    ret = {}
+    for (story_id, rows) in _rows_by_story(result).iteritems():
+      ret[story_id] = min(rows, key=lambda x: _to_datetime(x['date']))
     raise gen.Return(ret)
 
   @gen.coroutine
@@ -510,10 +1036,7 @@ class Thread(model.Thread):
   #     t = Thread(uri= "random%d" % x, featured_tweet=featured_tweet)
   #     results.append(t)
   #   raise gen.Return(results)
-  @staticmethod
-  @gen.coroutine
-  def fetch_from_story(story):
-    q = Template("""
+  _threads_query = prepare("threads", """
       PREFIX sioc: <http://rdfs.org/sioc/ns#>
       PREFIX pheme: <http://www.pheme.eu/ontology/pheme#>
       PREFIX dlpo: <http://www.semanticdesktop.org/ontologies/2011/10/05/dlpo#>
@@ -529,11 +1052,11 @@ class Thread(model.Thread):
             ?tweet pheme:version ?pheme_version.
             FILTER ( ?pheme_version IN $pheme_versions ).
             ?tweet sioc:has_container ?thread .
-            ?tweet pheme:dataChannel "$data_channel_id" .
+            ?tweet pheme:dataChannel $data_channel_id .
             ?tweet pheme:createdAt ?date .
             ?tweet sioc:has_creator ?user .
             ?user pheme:twitterUserVerified ?verified .
-            ?tweet pheme:eventId "$event_id" .
+            ?tweet pheme:eventId $event_id .
             } group by ?thread 
           }
         ?tweet pheme:sourceType ?sourceType .
@@ -552,13 +1075,19 @@ class Thread(model.Thread):
         }
         order by DESC(?verified) DESC(?numberOfFollowers)
         limit 100
-    """).substitute(event_id=story['event_id'], data_channel_id=story['channel_id'], pheme_versions=_graphdb_pheme_versions)
-    result = yield query(q)
+    """, results_format="tsv", priority=http_clients.INTERACTIVE,
+    event_id=_literal, data_channel_id=_literal)
+
+  @staticmethod
+  @_cached("threads", _story_dict_watermark)
+  @gen.coroutine
+  def fetch_from_story(story):
+    result = yield Thread._threads_query.run(event_id=story['event_id'], data_channel_id=story['channel_id'])
 
     results = []
     for x in result:
       if x['sourceType'].lower() == 'twitter':
-        tweet_id = re.match(r'.*\D(\d+)$', x['thread'].decode())
+        tweet_id = re.match(r'.*\D(\d+)$', unicode(x['thread']))
         if tweet_id is None:
           raise Exception("Unparseable tweet_id from result %s" % str(x))
         else:
@@ -570,14 +1099,14 @@ class Thread(model.Thread):
         tweet_id= tweet_id,
         source_type= x['sourceType'],
         text= unicode(x['text']),
-        date= iso8601.parse_date(x['first'].decode()),
+        date= _to_datetime(x['first']),
         veracity= _str_to_bool(x['veracity']),
         veracity_score= x['veracity_score'] or 0.0,
         user= dict(
           profile_image_url = x['avatar'],
           user_description = x['userName'],
           user_screen_name = x['accountName'],
-          is_verified = (x['verified'].capitalize() == 'True')
+          is_verified = _str_to_bool(x['verified'])
           )
         )
       #
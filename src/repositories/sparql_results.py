@@ -0,0 +1,247 @@
+# Decoding of SPARQL query results.
+#
+# Results are turned into plain rows: dicts of variable name -> native Python
+# value (unicode, int, float, bool or datetime). Unbound variables read as None.
+#
+# Decoders are fed the response data as it arrives and return the rows
+# completed so far, close() returns any remaining rows.
+
+from json import loads
+import re
+
+import iso8601
+
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+_int_types = set(map(lambda t: XSD + t, [
+  "integer", "int", "long", "short", "byte",
+  "nonNegativeInteger", "positiveInteger", "nonPositiveInteger", "negativeInteger",
+  "unsignedLong", "unsignedInt", "unsignedShort", "unsignedByte" ]))
+_float_types = set(map(lambda t: XSD + t, [ "decimal", "double", "float" ]))
+
+class Row(dict):
+  def __missing__(self, key):
+    return None
+
+def term_value(term):
+  """
+  Native value of an RDF term in SPARQL JSON results format, e.g.
+  { "type": "literal", "value": "3", "datatype": "...#integer" } -> 3
+  """
+  if term.get('type') == 'bnode':
+    return term.get('value')
+  return literal_value(term.get('value'), term.get('datatype'))
+
+def literal_value(value, datatype):
+  if datatype is None:
+    return value
+  elif datatype in _int_types:
+    return int(value)
+  elif datatype in _float_types:
+    return float(value)
+  elif datatype == XSD + "boolean":
+    return value in [ "true", "1" ]
+  elif datatype == XSD + "dateTime":
+    return iso8601.parse_date(value)
+  else:
+    return value
+
+def decode_binding(binding):
+  return Row(map(lambda (var, term): (var, term_value(term)), binding.iteritems()))
+
+
+class JSONResultsDecoder(object):
+  """
+  Incremental decoder for application/sparql-results+json. Data is fed as it
+  arrives, and each complete binding in the results is decoded into a row as
+  soon as it has been received, so only the data of the row currently being
+  received has to be buffered.
+  """
+  # Beginning of the bindings array
+  _bindings_re = re.compile(r'"bindings"\s*:\s*\[')
+  # Tokens to look for while scanning a binding: strings (which are skipped
+  # whole, possibly unterminated at the end of the data) and braces
+  _token_re = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*("|\\?\Z)|[{}]', re.S)
+  _separator_re = re.compile(r'[\s,]*')
+
+  def __init__(self):
+    self.buf = ""
+    self.pos = 0            # scan position in buf
+    self.state = 'prelude'  # prelude -> bindings -> done
+    self.depth = 0          # nesting level of braces in the current binding
+    self.row_start = None   # position in buf of the current binding
+
+  def feed(self, data):
+    # Returns the list of rows completed with the given data
+    self.buf += data
+    rows = []
+    if self.state == 'prelude':
+      m = self._bindings_re.search(self.buf)
+      if m is None:
+        return rows
+      self.state = 'bindings'
+      self.pos = m.end()
+    if self.state == 'bindings':
+      self._scan(rows)
+    # Forget about the data already consumed
+    cut = self.row_start if self.depth > 0 else self.pos
+    self.buf = self.buf[cut:]
+    self.pos -= cut
+    if self.row_start is not None:
+      self.row_start -= cut
+    return rows
+
+  def _scan(self, rows):
+    buf = self.buf
+    while True:
+      if self.depth == 0:
+        # in between bindings
+        self.pos = self._separator_re.match(buf, self.pos).end()
+        if self.pos >= len(buf):
+          return
+        c = buf[self.pos]
+        if c == ']':
+          self.state = 'done'
+          self.pos += 1
+          return
+        elif c != '{':
+          raise Exception("Unexpected '%s' in SPARQL results bindings" % c)
+        self.row_start = self.pos
+        self.depth = 1
+        self.pos += 1
+      m = self._token_re.search(buf, self.pos)
+      if m is None:
+        self.pos = len(buf)
+        return
+      token = m.group()
+      if token[0] == '"':
+        if m.group(1) != '"':
+          # the string is not complete yet, wait for more data
+          self.pos = m.start()
+          return
+      elif token == '{':
+        self.depth += 1
+      elif token == '}':
+        self.depth -= 1
+        if self.depth == 0:
+          rows.append(decode_binding(loads(buf[self.row_start:m.end()])))
+          self.row_start = None
+      self.pos = m.end()
+
+  def close(self):
+    if self.state != 'done':
+      raise Exception("Incomplete SPARQL results (state=%s)" % self.state)
+    return []
+
+
+class RDFLibResultsDecoder(object):
+  """
+  Decodes the complete results with rdflib (which is not required otherwise,
+  and only imported when this decoder is used). Kept as a fallback and for
+  checking the results of the decoder above.
+  """
+  def __init__(self):
+    self.chunks = []
+
+  def feed(self, data):
+    self.chunks.append(data)
+    return []
+
+  def close(self):
+    from rdflib.plugins.sparql.results.jsonresults import JSONResult
+    result = JSONResult(loads("".join(self.chunks)))
+    return map(lambda row: Row(map(lambda (var, term): (unicode(var), _rdflib_term_value(term)),
+                                   row.asdict().iteritems())),
+               result)
+
+def _rdflib_term_value(term):
+  value = term.toPython()
+  if isinstance(value, unicode):
+    # plain unicode rather than the rdflib term classes
+    value = unicode(value)
+  return value
+
+
+
+_tsv_escape_re = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+_tsv_escapes = { 't': u'\t', 'n': u'\n', 'r': u'\r', 'b': u'\b', 'f': u'\f' }
+
+def _tsv_unescape(m):
+  if m.group(3) is not None:
+    return _tsv_escapes.get(m.group(3), m.group(3))
+  return unichr(int(m.group(1) or m.group(2), 16))
+
+def tsv_term_value(field):
+  """
+  Native value of an RDF term in SPARQL TSV results format, e.g.
+  "3"^^<...#integer> -> 3. Empty fields are unbound variables.
+  """
+  if field == u'':
+    return None
+  c = field[0]
+  if c == u'"':
+    end = field.rindex(u'"')
+    value = field[1:end]
+    if u'\\' in value:
+      value = _tsv_escape_re.sub(_tsv_unescape, value)
+    suffix = field[end+1:]
+    if suffix.startswith(u'^^<'):
+      return literal_value(value, suffix[3:-1])
+    return value
+  elif c == u'<':
+    return field[1:-1]
+  elif c == u'_':
+    return field[2:]
+  elif field in [ u'true', u'false' ]:
+    return field == u'true'
+  else:
+    # bare numeric literal
+    try:
+      return int(field)
+    except ValueError:
+      return float(field)
+
+
+class TSVResultsDecoder(object):
+  """
+  Incremental decoder for text/tab-separated-values results. Terms can't
+  contain raw tabs or newlines in this format, so the results are decoded a
+  line at a time. It is more compact than JSON for text heavy results, but
+  unlike JSON it does not stream well for long single values.
+  """
+  def __init__(self):
+    self.buf = ""
+    self.vars = None
+
+  def feed(self, data):
+    lines = (self.buf + data).split("\n")
+    self.buf = lines.pop()
+    return self._decode(lines)
+
+  def _decode(self, lines):
+    rows = []
+    for line in lines:
+      fields = line.rstrip("\r").decode('utf-8').split(u'\t')
+      if self.vars is None:
+        self.vars = map(lambda v: v.lstrip(u'?'), fields)
+      elif fields != [ u'' ] or len(self.vars) == 1:
+        rows.append(Row(zip(self.vars, map(tsv_term_value, fields))))
+    return rows
+
+  def close(self):
+    rows = self._decode([ self.buf ]) if self.buf != "" else []
+    self.buf = ""
+    if self.vars is None:
+      raise Exception("Incomplete SPARQL results (no header)")
+    return rows
+
+decoders = {
+  "native": JSONResultsDecoder,
+  "rdflib": RDFLibResultsDecoder
+}
+
+# Decoders and content types by results format
+formats = {
+  "json": ("application/sparql-results+json", decoders),
+  "tsv": ("text/tab-separated-values", { "native": TSVResultsDecoder })
+}
@@ -1,4 +1,4 @@
-from tornado.httpclient import HTTPError, HTTPRequest, AsyncHTTPClient
+from tornado.httpclient import HTTPError, HTTPRequest
 from tornado import gen
 from my_json import loads, dumps
 from string import Template
@@ -8,6 +8,7 @@ import logging, time, re, urllib, pytz, os, iso8601
 from datetime import datetime
 
 import model
+import http_clients
 from tasks import SelfRegulatingTask, register_task
 
 logger = logging.getLogger('tornado.general')
@@ -371,8 +372,7 @@ class UshahidiV3Link(object):
           },
         body=dumps(self.build_token_request()),
       )
-      http_client = AsyncHTTPClient()
-      response = yield http_client.fetch(r)
+      response = yield http_clients.get_upstream('ush_v3').fetch(r)
       if response.error:
           raise Exception("Bad Oauth token response " + str(response))
       else:
@@ -403,9 +403,8 @@ class UshahidiV3Link(object):
       logger.info("[ush_v3] sending %s to %s" % (kwargs['method'], url))
       
       r = HTTPRequest(url, **kwargs)
-      http_client = AsyncHTTPClient()
       try:
-        response = yield http_client.fetch(r)
+        response = yield http_clients.get_upstream('ush_v3').fetch(r)
       except HTTPError, e:
         logger.error("-- v3 operation yielded error code. Response body:\n%s" % str(e.response.body))
         raise e
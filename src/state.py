@@ -2,77 +2,461 @@
 
 from threading import Thread
 from tornado import gen, ioloop
-from tornado.queues import Queue as AsyncQueue
-import random, json, time, logging, Queue
-import shelve
-
-_db = None
-_cmd_q = None   # command queue (consumed by db loop)
-_val_q = None   # values queue  (consumed by io loop)
-_thread = None
-
-def _db_loop():
-  global _db, _cmd_q, _val_q
-  io_loop = ioloop.IOLoop.instance()
-  quit = False
-  while not quit:
-    q_cmd = None
-    try:
-      q_cmd = _cmd_q.get(True)
-    except Queue.Empty:
-      continue
-    #
-    if q_cmd is None or not 'cmd' in q_cmd:
-      pass
-    elif q_cmd['cmd'] == 'get':
-      k = q_cmd['key']
-      if not _db.has_key(k):
-        v = None
-      else:
-        v = _db[k]
-      io_loop.add_callback(_return_val, v)   # queue response to the io loop
-    elif q_cmd['cmd'] == 'set':
-      k, v = q_cmd['key'], q_cmd['value']
-      _db[k] = v
-      _db.sync()      # playing it safe here
-    elif q_cmd['cmd'] == 'quit':
-      quit = True
-    # end of task
-    _cmd_q.task_done()
-  # end of loop
-  _db.close()
-
-def _return_val(value):
-  global _val_q
-  _val_q.put(value)
+from tornado.concurrent import Future
+from collections import OrderedDict
+import random, json, time, logging, Queue, itertools, zlib
+
+from tasks import SelfRegulatingTask
+import state_backends
+
+logger = logging.getLogger('tornado.general')
+
+# The state is split in one or more shards, each one with its own backend
+# and db loop thread. Keys are assigned to shards by a stable hash, so that
+# slow writes on a shard don't hold up the commands for the others.
+_shards = []
+
+# Futures of the commands waiting for a response, by request id. This dict
+# is only ever touched from the io loop.
+_pending = {}
+_req_ids = itertools.count()
+
+# In-memory LRU cache in front of the db. All the writers of the state live in
+# this process and go through set(), so the cache is kept up to date by writing
+# through it, and repeated reads are answered without leaving the io loop.
+# Entries can be given a time to live, by key prefix, to bound their staleness.
+# A time to live of 0 keeps the keys out of the cache (e.g. large values that
+# would take the place of many small ones).
+DEFAULT_CACHE_TTLS = {
+  "canonical_url_": 3600,
+  "story_texts.": 0,
+}
+
+class LRUCache(object):
+  def __init__(self, max_size=4096, ttls=None):
+    self.max_size = max_size
+    self.ttls = ttls if ttls is not None else DEFAULT_CACHE_TTLS
+    self.entries = OrderedDict()    # key -> (value, expiry time or None)
+    # Writes are numbered, so that a value read from the db can be told apart
+    # from a later write. Write generations are only kept for the keys being
+    # read (see read_started / fill).
+    self.generation = 0
+    self.reading = {}               # key -> number of reads in flight
+    self.written = {}               # key being read -> generation of its last write
+    self.prefix_deleted = 0         # generation of the last delete_prefix
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  def _ttl(self, k):
+    # longest matching prefix wins
+    ttl, match_len = None, -1
+    for (prefix, prefix_ttl) in self.ttls.iteritems():
+      if k.startswith(prefix) and len(prefix) > match_len:
+        ttl, match_len = prefix_ttl, len(prefix)
+    return ttl
+
+  def lookup(self, k):
+    # Returns a tuple (found, value)
+    entry = self.entries.pop(k, None)
+    if entry is not None and entry[1] is not None and entry[1] <= time.time():
+      self.expirations += 1
+      entry = None
+    if entry is None:
+      self.misses += 1
+      return (False, None)
+    self.entries[k] = entry   # re-insert as most recently used
+    self.hits += 1
+    return (True, entry[0])
+
+  def _write(self, k):
+    self.generation += 1
+    if k in self.reading:
+      self.written[k] = self.generation
+
+  def put(self, k, v, expires=None):
+    # expires is the expiry time of the key itself, if it has any
+    self._write(k)
+    self._insert(k, v, expires)
+
+  def _insert(self, k, v, expires):
+    ttl = self._ttl(k)
+    self.entries.pop(k, None)
+    if ttl == 0:
+      return
+    if ttl is not None:
+      expires = min(expires or float('inf'), time.time() + ttl)
+    self.entries[k] = (v, expires)
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+      self.evictions += 1
+
+  def read_started(self, k):
+    # Call before reading k from the db, returns the token to fill it with
+    self.reading[k] = self.reading.get(k, 0) + 1
+    return self.generation
+
+  def fill(self, k, v, expires, token):
+    # Like put, with a value read from the db since read_started returned
+    # token. The value is dropped if k has been written (set or deleted) in
+    # the meantime, even if it has been evicted since.
+    n = self.reading.pop(k, 1) - 1
+    written = self.written.get(k, 0)
+    if n > 0:
+      self.reading[k] = n
+    else:
+      self.written.pop(k, None)
+    if written > token or self.prefix_deleted > token:
+      return
+    if k not in self.entries:
+      self._insert(k, v, expires)
+
+  def delete_prefix(self, prefix):
+    self.generation += 1
+    self.prefix_deleted = self.generation
+    for k in filter(lambda k: k.startswith(prefix), self.entries.keys()):
+      del self.entries[k]
+
+  def stats(self):
+    return dict(
+      cache_size= len(self.entries),
+      cache_hits= self.hits,
+      cache_misses= self.misses,
+      cache_evictions= self.evictions,
+      cache_expirations= self.expirations,
+      )
+
+_cache = LRUCache()
+
+class _Shard(object):
+  """
+  One db loop thread over one backend. Commands are put in its queue from the
+  io loop and applied in order.
+
+  Group commit: sets are applied to the db as they arrive, but it is only
+  synced once the command queue runs dry (waiting up to sync_max_latency
+  seconds for further sets), or when sync_max_batch sets are pending sync.
+  """
+  def __init__(self, db, sync_max_latency=0.1, sync_max_batch=256):
+    self.db = db    # storage backend (see state_backends)
+    self.cmd_q = Queue.Queue()  # command queue (consumed by db loop)
+    self.sync_max_latency = sync_max_latency
+    self.sync_max_batch = sync_max_batch
+    # Counters about the work performed by the db loop
+    self.stats = dict(
+      sets= 0,            # total number of sets applied
+      expired= 0,         # total number of expired keys swept
+      dated= 0,           # total number of keys given an expiry time by a sweep
+      syncs= 0,           # total number of syncs
+      max_batch= 0,       # largest number of sets covered by a single sync
+      last_batch= 0,      # number of sets covered by the last sync
+      sync_time= 0.0,     # total time spent syncing, in seconds
+      max_sync_time= 0.0, # slowest sync, in seconds
+      )
+    # ... run db_loop in its own thread ...
+    self.thread = Thread(target=self._db_loop)
+    self.thread.start()
+
+  def put(self, cmd):
+    self.cmd_q.put(cmd, False)
+
+  def request(self, cmd, **kwargs):
+    # Send a command that expects a response, return the Future for it
+    req_id = next(_req_ids)
+    future = Future()
+    _pending[req_id] = future
+    self.put(dict(cmd=cmd, req_id=req_id, **kwargs))
+    return future
+
+  def _sync(self, batch):
+    t0 = time.time()
+    self.db.sync()
+    t = time.time() - t0
+    self.stats['syncs'] += 1
+    self.stats['max_batch'] = max(self.stats['max_batch'], batch)
+    self.stats['last_batch'] = batch
+    self.stats['sync_time'] += t
+    self.stats['max_sync_time'] = max(self.stats['max_sync_time'], t)
+
+  def _apply(self, q_cmd, io_loop):
+    # Run a command against the db, returns the number of keys written
+    cmd = q_cmd['cmd']
+    now = time.time()
+    written = 0
+    if cmd == 'get':
+      v = self.db.get(q_cmd['key'], now)
+    elif cmd == 'get_many':
+      v = self.db.get_many(q_cmd['keys'], now)
+    elif cmd == 'scan':
+      v = self.db.scan(q_cmd['prefix'], now)
+    elif cmd == 'set':
+      self.db.set(q_cmd['key'], q_cmd['value'], q_cmd['expires'])
+      written = 1
+    elif cmd == 'set_many':
+      self.db.set_many(q_cmd['items'])
+      written = len(q_cmd['items'])
+    elif cmd == 'delete_prefix':
+      v = written = self.db.delete_prefix(q_cmd['prefix'])
+    elif cmd == 'sweep':
+      removed, dated, done = self.db.sweep(now, q_cmd['limit'], q_cmd['default_ttls'])
+      v = (removed, done)
+      self.stats['expired'] += removed
+      self.stats['dated'] += dated
+      written = removed + dated
+    elif cmd == 'compact':
+      v = self.db.compact()
+    else:
+      return 0
+    if cmd in [ 'set', 'set_many' ]:
+      self.stats['sets'] += written
+    if 'req_id' in q_cmd:
+      io_loop.add_callback(_return_val, q_cmd['req_id'], v)   # queue response to the io loop
+    return written
+
+  def _db_loop(self):
+    io_loop = ioloop.IOLoop.instance()
+    quit = False
+    unsynced = 0          # number of sets applied since the last sync
+    sync_deadline = None  # time by which those sets should have been synced
+    while not quit:
+      q_cmd = None
+      try:
+        if unsynced == 0:
+          q_cmd = self.cmd_q.get(True)
+        else:
+          q_cmd = self.cmd_q.get(True, max(sync_deadline - time.time(), 0))
+      except Queue.Empty:
+        # the queue has run dry, commit the pending sets
+        self._sync(unsynced)
+        unsynced = 0
+        continue
+      #
+      if q_cmd is not None and q_cmd.get('cmd') == 'quit':
+        quit = True
+      elif q_cmd is not None and 'cmd' in q_cmd:
+        if q_cmd['cmd'] == 'compact' and unsynced > 0:
+          self._sync(unsynced)
+          unsynced = 0
+        written = self._apply(q_cmd, io_loop)
+        if written > 0:
+          if unsynced == 0:
+            sync_deadline = time.time() + self.sync_max_latency
+          unsynced += written
+      # end of task
+      self.cmd_q.task_done()
+      # commit if the batch is full, the latency budget has been used up while
+      # other commands kept coming, or we are quitting
+      if unsynced > 0 and (quit or unsynced >= self.sync_max_batch or \
+          (self.sync_max_latency > 0 and time.time() >= sync_deadline)):
+        self._sync(unsynced)
+        unsynced = 0
+    # end of loop
+    self.db.close()
+
+def _return_val(req_id, value):
+  future = _pending.pop(req_id, None)
+  if future is not None:
+    future.set_result(value)
+
+def shard_of(k, n_shards):
+  # Stable across processes and restarts (unlike hash())
+  return (zlib.crc32(k) & 0xffffffff) % n_shards
+
+def _shard(k):
+  return _shards[shard_of(k, len(_shards))]
+
+def _by_shard(keys):
+  # Group keys by the index of their shard
+  ret = {}
+  for k in keys:
+    ret.setdefault(shard_of(k, len(_shards)), []).append(k)
+  return ret
+
+def _gather(futures, on_results):
+  # Resolves to on_results(list of results), once all the futures are done
+  future = Future()
+  if len(futures) == 0:
+    future.set_result(on_results([]))
+    return future
+  results = [ None ] * len(futures)
+  remaining = [ len(futures) ]
+  def on_done(i, f):
+    results[i] = f.result()
+    remaining[0] -= 1
+    if remaining[0] == 0:
+      future.set_result(on_results(results))
+  for (i, f) in enumerate(futures):
+    f.add_done_callback(lambda f, i=i: on_done(i, f))
+  return future
 
 ## -- Module interface (to use from the IO loop) --
-__all__ = [ "init", "get", "set", "quit" ]
-
-def init(path):
-  global _db, _cmd_q, _val_q, _thread
-  _db = shelve.open(path)
-  _cmd_q = Queue.Queue() # command queue (consumed by db loop)
-  _val_q = AsyncQueue()  # values queue  (consumed by io loop)
-  # ... run db_loop in its own thread ...
-  _thread = Thread(target=_db_loop)
-  _thread.start()
-
-@gen.coroutine
+__all__ = [ "init", "get", "set", "get_many", "set_many", "scan", "delete_prefix",
+            "quit", "stats", "sweep", "compact", "StateMaintenanceTask" ]
+
+def init(path, backend="shelve", shards=1, sync_max_latency=0.1, sync_max_batch=256, cache_size=4096, cache_ttls=None):
+  """
+  Open the state db at the given path and start the db loop(s)
+    * backend : name of the storage backend, one of state_backends.backends
+    * shards : number of backing files and db loop threads
+    * sync_max_latency : max seconds to wait for further sets before syncing
+    * sync_max_batch : max number of sets to apply before syncing
+    * cache_size : max number of keys held in the in-memory cache
+    * cache_ttls : dict of key prefix -> seconds that cached values live
+  """
+  global _shards, _cache
+  _cache = LRUCache(max_size=cache_size, ttls=cache_ttls)
+  dbs = state_backends.open_backends(backend, path, shards=shards, shard_of=shard_of)
+  _shards = map(lambda db: _Shard(db, sync_max_latency=sync_max_latency, sync_max_batch=sync_max_batch), dbs)
+
 def get(k):
-  global _cmd_q, _val_q
-  _cmd_q.put(dict(cmd='get', key=k), True)    # Block while putting get commands to ensure consistent order
-  value = yield _val_q.get()
-  _val_q.task_done()
-  raise gen.Return(value)
+  # Values in the cache are returned straight away. Otherwise, each get
+  # carries its own request id, so that any number of coroutines can have
+  # reads in flight and each one is resolved with its own value.
+  # Commands are still applied in order by each db loop, so a get always
+  # sees the sets queued before it.
+  found, v = _cache.lookup(k)
+  if found:
+    future = Future()
+    future.set_result(v)
+    return future
+  future = Future()
+  token = _cache.read_started(k)
+  def on_value(f):
+    v, expires = f.result()
+    _cache.fill(k, v, expires, token)
+    future.set_result(v)
+  _shard(k).request('get', key=k).add_done_callback(on_value)
+  return future
+
+def set(k, v, ttl=None):
+  # Cached values are handed out as they are, don't modify them in place.
+  # If ttl (in seconds) is given, the key reads as missing after that time.
+  expires = time.time() + ttl if ttl is not None else None
+  _cache.put(k, v, expires)
+  _shard(k).put(dict(cmd='set', key=k, value=v, expires=expires))
+
+def get_many(keys):
+  # Resolves to a dict with the value of each of the keys (None if missing),
+  # the ones not in the cache are read with a single command per shard
+  values = {}
+  misses = []
+  for k in keys:
+    found, v = _cache.lookup(k)
+    if found:
+      values[k] = v
+    else:
+      misses.append(k)
+  if len(misses) == 0:
+    future = Future()
+    future.set_result(values)
+    return future
+  tokens = dict(map(lambda k: (k, _cache.read_started(k)), misses))
+  def on_results(results):
+    for result in results:
+      for (k, (v, expires)) in result.iteritems():
+        _cache.fill(k, v, expires, tokens[k])
+        values[k] = v
+    return values
+  return _gather(
+    map(lambda (i, ks): _shards[i].request('get_many', keys=ks), _by_shard(misses).iteritems()),
+    on_results)
+
+def set_many(mapping, ttl=None):
+  # Set all the key/values in the mapping dict, with a single command per shard
+  expires = time.time() + ttl if ttl is not None else None
+  for k in mapping.iterkeys():
+    _cache.put(k, mapping[k], expires)
+  for (i, ks) in _by_shard(mapping.keys()).iteritems():
+    _shards[i].put(dict(cmd='set_many', items=map(lambda k: (k, mapping[k], expires), ks)))
 
-def set(k, v):
-  global _cmd_q
-  _cmd_q.put(dict(cmd='set', key=k, value=v), False)
+def scan(prefix):
+  # Resolves to a dict with all the keys starting with prefix and their values
+  def on_results(results):
+    ret = {}
+    for result in results:
+      for (k, (v, expires)) in result.iteritems():
+        ret[k] = v
+    return ret
+  return _gather(map(lambda shard: shard.request('scan', prefix=prefix), _shards), on_results)
+
+def delete_prefix(prefix):
+  # Delete all the keys starting with prefix, resolves to the number deleted
+  _cache.delete_prefix(prefix)
+  return _gather(map(lambda shard: shard.request('delete_prefix', prefix=prefix), _shards), sum)
 
 def quit():
-  global _cmd_q
-  _cmd_q.put(dict(cmd='quit'))
+  for shard in _shards:
+    shard.put(dict(cmd='quit'))
+
+def stats():
+  ret = dict(shards= len(_shards))
+  for shard in _shards:
+    for (k, v) in shard.stats.iteritems():
+      if k.startswith('max_') or k.startswith('last_'):
+        ret[k] = max(ret.get(k, v), v)
+      else:
+        ret[k] = ret.get(k, 0) + v
+  ret.update(_cache.stats())
+  return ret
+
+# Time to live of the keys written without an expiry time by earlier versions,
+# by key prefix. The sweep gives them one, so that they don't stay forever.
+DEFAULT_KEY_TTLS = {
+  "canonical_url_": 30 * 24 * 3600,
+  "story_cached_data.": 30 * 24 * 3600,
+}
+
+# Indexes of the shards that have finished the current sweep pass
+_swept = []
+
+def sweep(limit=500, default_ttls=None):
+  # Remove (up to limit per shard) expired keys from the db, and give the keys
+  # without an expiry time one from default_ttls (DEFAULT_KEY_TTLS by
+  # default). Resolves to (removed, done)
+  default_ttls = default_ttls if default_ttls is not None else DEFAULT_KEY_TTLS
+  global _swept
+  sweeping = filter(lambda i: i not in _swept, range(len(_shards)))
+  def on_results(results):
+    global _swept
+    for (i, (removed, done)) in zip(sweeping, results):
+      if done:
+        _swept.append(i)
+    all_done = len(_swept) == len(_shards)
+    if all_done:
+      _swept = []
+    return (sum(map(lambda r: r[0], results)), all_done)
+  return _gather(map(lambda i: _shards[i].request('sweep', limit=limit, default_ttls=default_ttls), sweeping), on_results)
+
+def compact():
+  # Give back to the file system the space of deleted keys
+  return _gather(map(lambda shard: shard.request('compact'), _shards), lambda results: None)
+
+class StateMaintenanceTask(SelfRegulatingTask):
+  """
+  Periodically sweeps expired keys and compacts the state db. Sweeping is
+  done in small batches, so that the db loop keeps serving other commands
+  in between
+    * interval : seconds between maintenance runs
+  """
+  def __init__(self, **kwargs):
+    kwargs.setdefault('timeout', 3600)
+    super(StateMaintenanceTask, self).__init__(**kwargs)
+    self.interval = kwargs['interval'] if 'interval' in kwargs else 6 * 3600
+
+  @gen.coroutine
+  def workload(self):
+    try:
+      removed, done = 0, False
+      while not done:
+        n, done = yield sweep()
+        removed += n
+        yield gen.sleep(0.1)
+      logger.info("State maintenance: swept %d expired keys" % removed)
+      if removed > 0:
+        yield compact()
+    finally:
+      self.next_exec = time.time() + self.interval
 
 
 if __name__ == "__main__":
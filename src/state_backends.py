@@ -0,0 +1,344 @@
+# Storage engines behind the state module.
+#
+# A backend is a simple key/value store where every key can optionally carry
+# an expiry time (seconds since the epoch). get() returns a (value, expires)
+# tuple, expired keys read as missing, and are removed for good by sweep().
+# Methods are only ever called from the state db thread (see state._db_loop),
+# and writes may be buffered until sync().
+
+from collections import namedtuple
+import cPickle as pickle
+import os, re, logging, shelve, sqlite3, whichdb
+
+logger = logging.getLogger('tornado.general')
+
+# Shelve values that have an expiry time are stored wrapped in one of these
+ExpiringValue = namedtuple('ExpiringValue', [ 'value', 'expires' ])
+
+def _default_ttl(k, default_ttls):
+  # Time to live given by sweep() to a key without an expiry time, from the
+  # longest prefix of default_ttls (prefix -> seconds) that matches it
+  ttl, match_len = None, -1
+  for (prefix, prefix_ttl) in default_ttls.iteritems():
+    if k.startswith(prefix) and len(prefix) > match_len:
+      ttl, match_len = prefix_ttl, len(prefix)
+  return ttl
+
+class ShelveBackend(object):
+  """
+  The original storage, a shelve file at the given path (the dbm module in use
+  may add an extension to it)
+  """
+  def __init__(self, path):
+    self.db = shelve.open(path)
+    self._sweep_keys = None   # keys left to examine in the current sweep
+
+  @staticmethod
+  def exists(path):
+    return whichdb.whichdb(path) not in [ None, '' ]
+
+  @staticmethod
+  def files(path):
+    # the files of the store, whichever dbm module created them
+    return filter(os.path.exists, map(lambda ext: path + ext, [ '', '.db', '.dat', '.dir', '.bak', '.pag' ]))
+
+  def get(self, k, now):
+    if not self.db.has_key(k):
+      return (None, None)
+    v = self.db[k]
+    if isinstance(v, ExpiringValue):
+      return (v.value, v.expires) if v.expires > now else (None, None)
+    return (v, None)
+
+  def get_many(self, keys, now):
+    return dict(map(lambda k: (k, self.get(k, now)), keys))
+
+  def set(self, k, v, expires=None):
+    self.db[k] = ExpiringValue(v, expires) if expires is not None else v
+
+  def set_many(self, items):
+    # items is a list of (key, value, expires)
+    for (k, v, expires) in items:
+      self.set(k, v, expires)
+
+  def scan(self, prefix, now):
+    ret = {}
+    for k in filter(lambda k: k.startswith(prefix), self.db.keys()):
+      v, expires = self.get(k, now)
+      if v is not None:
+        ret[k] = (v, expires)
+    return ret
+
+  def delete_prefix(self, prefix):
+    keys = filter(lambda k: k.startswith(prefix), self.db.keys())
+    for k in keys:
+      del self.db[k]
+    return len(keys)
+
+  def items(self):
+    # yields (key, value, expires)
+    for k in self.db.keys():
+      v = self.db[k]
+      if isinstance(v, ExpiringValue):
+        yield (k, v.value, v.expires)
+      else:
+        yield (k, v, None)
+
+  def sweep(self, now, limit, default_ttls={}):
+    """
+    Examine up to limit keys, removing the expired ones. Successive calls
+    carry on where the previous one left. Keys without an expiry time are
+    given one from default_ttls (see _default_ttl). Returns (removed, dated,
+    done)
+    """
+    if self._sweep_keys is None:
+      self._sweep_keys = self.db.keys()
+    keys, self._sweep_keys = self._sweep_keys[:limit], self._sweep_keys[limit:]
+    removed, dated = 0, 0
+    for k in keys:
+      if not self.db.has_key(k):
+        continue
+      v = self.db[k]
+      if isinstance(v, ExpiringValue):
+        if v.expires <= now:
+          del self.db[k]
+          removed += 1
+      else:
+        ttl = _default_ttl(k, default_ttls)
+        if ttl is not None:
+          self.db[k] = ExpiringValue(v, now + ttl)
+          dated += 1
+    done = len(self._sweep_keys) == 0
+    if done:
+      self._sweep_keys = None
+    return (removed, dated, done)
+
+  def compact(self):
+    # only gdbm knows how to give back the space of deleted keys
+    if hasattr(self.db.dict, 'reorganize'):
+      self.db.dict.reorganize()
+
+  def sync(self):
+    self.db.sync()
+
+  def close(self):
+    self.db.close()
+
+
+class SQLiteBackend(object):
+  """
+  SQLite database in WAL mode at <path>.sqlite, with one row per key. Sets are
+  grouped in a transaction that is committed on sync()
+  """
+  def __init__(self, path):
+    # The database is opened here but used from the db thread
+    self.conn = sqlite3.connect(self.filename(path), check_same_thread=False)
+    self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")   # only applies to new databases
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.execute("PRAGMA synchronous=NORMAL")
+    self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)")
+    columns = map(lambda row: row[1], self.conn.execute("PRAGMA table_info(state)"))
+    if 'expires' not in columns:
+      self.conn.execute("ALTER TABLE state ADD COLUMN expires REAL")
+    self.conn.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (expires)")
+    self.conn.commit()
+
+  @staticmethod
+  def filename(path):
+    return path + ".sqlite"
+
+  @staticmethod
+  def exists(path):
+    return os.path.exists(SQLiteBackend.filename(path))
+
+  @staticmethod
+  def files(path):
+    filename = SQLiteBackend.filename(path)
+    return filter(os.path.exists, [ filename, filename + '-wal', filename + '-shm' ])
+
+  def get(self, k, now):
+    row = self.conn.execute("SELECT value, expires FROM state WHERE key = ?", (k,)).fetchone()
+    if row is None or (row[1] is not None and row[1] <= now):
+      return (None, None)
+    return (pickle.loads(str(row[0])), row[1])
+
+  def get_many(self, keys, now):
+    ret = dict(map(lambda k: (k, (None, None)), keys))
+    # keep clear of the limit of variables in a statement
+    for i in range(0, len(keys), 500):
+      chunk = keys[i:i+500]
+      rows = self.conn.execute(
+        "SELECT key, value, expires FROM state WHERE key IN (%s)" % ",".join("?" * len(chunk)),
+        chunk)
+      for (k, v, expires) in rows:
+        if expires is None or expires > now:
+          ret[str(k)] = (pickle.loads(str(v)), expires)
+    return ret
+
+  def set(self, k, v, expires=None):
+    self.conn.execute("INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+      (k, sqlite3.Binary(pickle.dumps(v, pickle.HIGHEST_PROTOCOL)), expires))
+
+  def set_many(self, items):
+    # items is a list of (key, value, expires)
+    self.conn.executemany("INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+      map(lambda (k, v, expires): (k, sqlite3.Binary(pickle.dumps(v, pickle.HIGHEST_PROTOCOL)), expires), items))
+
+  def _prefix_range(self, prefix):
+    # keys starting with prefix are those in the range [prefix, upper), which
+    # makes use of the primary key index
+    if prefix == "":
+      return ("key >= ?", ("",))
+    upper = prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+    return ("key >= ? AND key < ?", (prefix, upper))
+
+  def scan(self, prefix, now):
+    cond, args = self._prefix_range(prefix)
+    ret = {}
+    for (k, v, expires) in self.conn.execute("SELECT key, value, expires FROM state WHERE " + cond, args):
+      if expires is None or expires > now:
+        ret[str(k)] = (pickle.loads(str(v)), expires)
+    return ret
+
+  def delete_prefix(self, prefix):
+    cond, args = self._prefix_range(prefix)
+    return self.conn.execute("DELETE FROM state WHERE " + cond, args).rowcount
+
+  def items(self):
+    # yields (key, value, expires)
+    for (k, v, expires) in self.conn.execute("SELECT key, value, expires FROM state"):
+      yield (str(k), pickle.loads(str(v)), expires)
+
+  def sweep(self, now, limit, default_ttls={}):
+    """
+    Remove up to limit expired keys, and give up to limit keys without an
+    expiry time one from default_ttls (see _default_ttl). Returns (removed,
+    dated, done)
+    """
+    removed = self.conn.execute(
+      "DELETE FROM state WHERE key IN (SELECT key FROM state WHERE expires <= ? LIMIT ?)",
+      (now, limit)).rowcount
+    dated = 0
+    # (longest prefixes first, so that they win over the shorter ones)
+    for prefix in sorted(default_ttls.keys(), key=len, reverse=True):
+      if dated >= limit:
+        break
+      cond, args = self._prefix_range(prefix)
+      dated += self.conn.execute(
+        "UPDATE state SET expires = ? WHERE key IN (SELECT key FROM state WHERE expires IS NULL AND " + cond + " LIMIT ?)",
+        (now + default_ttls[prefix],) + args + (limit - dated,)).rowcount
+    return (removed, dated, removed < limit and dated < limit)
+
+  def compact(self):
+    self.conn.commit()
+    if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+      self.conn.execute("PRAGMA incremental_vacuum").fetchall()
+    else:
+      self.conn.execute("VACUUM")
+    self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+  def sync(self):
+    self.conn.commit()
+
+  def close(self):
+    self.conn.commit()
+    self.conn.close()
+
+
+backends = {
+  "shelve": ShelveBackend,
+  "sqlite": SQLiteBackend,
+}
+
+def _copy(source, dest_of):
+  # Copy all the keys from source to the backend returned by dest_of(key)
+  n = 0
+  for (k, v, expires) in source.items():
+    dest_of(k).set(k, v, expires)
+    n += 1
+  return n
+
+def _layout_paths(path, shards):
+  # Paths of the backends of a store with the given number of shards
+  if shards == 1:
+    return [ path ]
+  return map(lambda i: "%s.shard%dof%d" % (path, i, shards), range(shards))
+
+def _layouts(path):
+  # (backend class, paths) of the stores found at path, sharded or not
+  directory, base = os.path.split(path)
+  shard_re = re.compile(re.escape(base) + r'\.shard\d+of(\d+)')
+  counts = set(map(lambda m: int(m.group(1)),
+    filter(None, map(shard_re.match, os.listdir(directory or '.')))))
+  ret = []
+  for shards in [ 1 ] + sorted(counts - set([ 1 ])):
+    paths = _layout_paths(path, shards)
+    for backend_class in [ ShelveBackend, SQLiteBackend ]:
+      if any(map(backend_class.exists, paths)):
+        ret.append((backend_class, paths))
+  return ret
+
+def _files(layout):
+  backend_class, paths = layout
+  return sum(map(backend_class.files, paths), [])
+
+def _last_modified(layout):
+  return max(map(os.path.getmtime, _files(layout)))
+
+def _retire(layout):
+  # Rename the files of a store that has been copied elsewhere, so that it's
+  # not opened again
+  for f in _files(layout):
+    os.rename(f, f + ".retired")
+
+def open_backend(name, path):
+  """
+  Open the backend with the given name at path, unsharded (see open_backends)
+  """
+  return open_backends(name, path)[0]
+
+def open_backends(name, path, shards=1, shard_of=None):
+  """
+  Open the list of backends for the given number of shards. With more than one
+  shard, the backend for shard i lives at <path>.shard<i>of<shards>, and
+  shard_of(key, shards) must tell the index of the shard for a key.
+  When the store doesn't exist yet, the keys of an existing store at path with
+  another backend or number of shards are copied into it, and that store is
+  retired (its files renamed to *.retired). Stores left behind by earlier
+  versions, which didn't retire them, are retired when they're older than the
+  one opened. Otherwise, which store is current can't be told, and opening
+  fails.
+  """
+  if name not in backends:
+    raise Exception("Unknown state backend '%s', must be one of %s" % (name, ", ".join(backends.keys())))
+  backend_class = backends[name]
+  target = (backend_class, _layout_paths(path, shards))
+  layouts = _layouts(path)
+  others = filter(lambda layout: layout != target, layouts)
+  if target in layouts:
+    newer = filter(lambda layout: _last_modified(layout) >= _last_modified(target), others)
+    if len(newer) > 0:
+      raise Exception("State stores %s are newer than %s, move away the stale ones" %
+        (", ".join(map(lambda layout: ",".join(layout[1]), newer)), ",".join(target[1])))
+    for layout in others:
+      logger.warning("Retiring stale state store %s" % ",".join(layout[1]))
+      _retire(layout)
+    others = []
+  elif len(others) > 1:
+    raise Exception("Several state stores found at %s (%s), move away the stale ones" %
+      (path, "; ".join(map(lambda layout: ",".join(layout[1]), others))))
+  dbs = map(backend_class, target[1])
+  if len(others) == 1:
+    source_class, source_paths = others[0]
+    logger.info("Copying state from %s into %d %s shard(s)" % (",".join(source_paths), shards, name))
+    dest_of = (lambda k: dbs[shard_of(k, shards)]) if shards > 1 else (lambda k: dbs[0])
+    n = 0
+    for source_path in source_paths:
+      source = source_class(source_path)
+      n += _copy(source, dest_of)
+      source.close()
+    for db in dbs:
+      db.sync()
+    _retire(others[0])
+    logger.info("Copied %d state keys" % n)
+  return dbs
@@ -75,6 +75,11 @@ class RecurrentTask(object):
   @gen.coroutine
   def _exec(self):
     # wraps workload execution for error handling and execution log tracking
+    # (a workload that timed out keeps running, the next execution is skipped
+    # until it finishes, so that they don't overlap)
+    if self.current_future is not None:
+      logger.warning("Task %s: previous execution still running, skipping this one" % self.task_id)
+      raise gen.Return()
     self.log.start_exec()
     try:
       self.current_future = self.workload()
@@ -86,7 +91,16 @@ class RecurrentTask(object):
       logger.error(traceback.format_exc())
       self.log.end_exec(e)
     finally:
-      self.current_future = None
+      if self.current_future is not None and not self.current_future.done():
+        self.current_future.add_done_callback(self._on_workload_done)
+      else:
+        self.current_future = None
+
+  def _on_workload_done(self, future):
+    # a workload that timed out has finished
+    self.current_future = None
+    if future.exception() is not None:
+      logger.error("Exception in task %s, after its timeout: %s" % (self.task_id, future.exception()))
 
   @gen.coroutine
   def loop(self):
@@ -127,6 +141,8 @@ class FuzzyRecurrentTask(RecurrentTask):
   The fuzziness will keep adding up as iterations go, and this will have the effect of
   spreading the several tasks more or less uniformly through time, even if they started
   at the same time.
+  A workload can set skip_next_sleep for the next execution to start right after it
+  (e.g. when there's a backlog to catch up with).
   """
   def __init__(self, *args, **kwargs):
     super(FuzzyRecurrentTask, self).__init__(**kwargs)
@@ -142,6 +158,7 @@ class FuzzyRecurrentTask(RecurrentTask):
         self.first_delay = randint(int(self.first_delay[0]), int(self.first_delay[1]))
       else:
         raise Exception("Invalid first_delay specification, it must be number or binary tuple/list")
+    self.skip_next_sleep = False
 
   @gen.coroutine
   def loop(self):
@@ -151,8 +168,10 @@ class FuzzyRecurrentTask(RecurrentTask):
       # The next execution will fall somewhere between (period * 0.67) and (period * 1.33)
       next_sleep = (self.period * 0.67) + randint(0, self.period * 2 / 3)
       next_period = gen.sleep(next_sleep)
+      self.skip_next_sleep = False
       yield self._exec()
-      yield next_period
+      if not self.skip_next_sleep:
+        yield next_period
 
 # List of tasks managed by this module
 task_roster = {}
@@ -0,0 +1,47 @@
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.httpclient import HTTPRequest
+from tornado import web, gen
+import unittest
+
+import http_clients
+
+class SlowHandler(web.RequestHandler):
+  n_requests = 0
+
+  @gen.coroutine
+  def get(self):
+    SlowHandler.n_requests += 1
+    yield gen.sleep(0.05)
+    self.write(self.request.headers.get('Accept', ''))
+
+class UpstreamFetchTest(AsyncHTTPTestCase):
+  def get_app(self):
+    return web.Application([ ('/', SlowHandler) ])
+
+  def setUp(self):
+    super(UpstreamFetchTest, self).setUp()
+    SlowHandler.n_requests = 0
+    self.upstream = http_clients.Upstream('test')
+
+  @gen_test
+  def test_dict_headers(self):
+    r = HTTPRequest(self.get_url('/'), headers={ 'Accept': 'application/json' })
+    response = yield self.upstream.fetch(r)
+    self.assertEqual(response.body, 'application/json')
+
+  @gen_test
+  def test_identical_requests_share_response(self):
+    make = lambda: HTTPRequest(self.get_url('/'), headers={ 'Accept': 'application/json' })
+    responses = yield [ self.upstream.fetch(make()), self.upstream.fetch(make()) ]
+    self.assertEqual(map(lambda r: r.body, responses), [ 'application/json' ] * 2)
+    self.assertEqual(SlowHandler.n_requests, 1)
+    self.assertEqual(self.upstream.stats()['shared'], 1)
+
+  @gen_test
+  def test_different_headers_not_shared(self):
+    yield [ self.upstream.fetch(HTTPRequest(self.get_url('/'), headers={ 'Accept': 'a/b' })),
+            self.upstream.fetch(HTTPRequest(self.get_url('/'), headers={ 'Accept': 'c/d' })) ]
+    self.assertEqual(SlowHandler.n_requests, 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,136 @@
+from datetime import datetime
+from tornado.testing import AsyncTestCase, gen_test
+from tornado import gen, ioloop
+import pytz, shutil, tempfile, unittest
+
+import state
+import pull_push
+from repositories import graphdb, ush_v3
+
+T0 = datetime(2016, 1, 1, tzinfo=pytz.utc)
+
+class Channel(object):
+  _id = 'test'
+
+class FakeV3Story(object):
+  saved = []
+
+  def __init__(self, story):
+    self.story = story
+    self._id = story._id
+    self._ush_id = 1
+
+  @gen.coroutine
+  def save(self):
+    yield gen.moment
+    if self.story.event_id == 'broken':
+      raise Exception("save failed")
+    FakeV3Story.saved.append(self.story.event_id)
+
+  @gen.coroutine
+  def upload_fulltext(self, fulltext):
+    pass
+
+class PushTest(AsyncTestCase):
+  def get_new_ioloop(self):
+    # (the state db loops return their results to the global IOLoop)
+    return ioloop.IOLoop.instance()
+
+  def setUp(self):
+    super(PushTest, self).setUp()
+    self.state_dir = tempfile.mkdtemp()
+    state.init(self.state_dir + '/state')
+    self.patched = [
+      (graphdb.Story, 'fetch_aggregates_many', graphdb.Story.__dict__['fetch_aggregates_many']),
+      (graphdb.Story, 'fetch_snapshot_many', graphdb.Story.__dict__['fetch_snapshot_many']),
+      (ush_v3.Story, 'as_copy', ush_v3.Story.__dict__['as_copy']) ]
+    graphdb.Story.fetch_aggregates_many = staticmethod(self.fetch_aggregates_many)
+    graphdb.Story.fetch_snapshot_many = staticmethod(self.fetch_snapshot_many)
+    ush_v3.Story.as_copy = staticmethod(lambda story, **kwargs: FakeV3Story(story))
+    FakeV3Story.saved = []
+    self.pull = pull_push.PullThemesGraphDb(Channel)
+    self.push = pull_push.PushThemesUshV3()
+
+  def tearDown(self):
+    for (cls, name, value) in self.patched:
+      setattr(cls, name, value)
+    state.quit()
+    for shard in state._shards:
+      shard.thread.join()
+    shutil.rmtree(self.state_dir)
+    super(PushTest, self).tearDown()
+
+  @gen.coroutine
+  def fetch_aggregates_many(self, stories, since={}):
+    # (like the query, a story bound twice has its tweets counted twice)
+    ret = {}
+    for story in stories:
+      x = ret.setdefault(story._id,
+        dict(size=0, verified_count=0, start_date=T0, until=T0, images=set(), urls=set(), sdq={}))
+      x['size'] += 5
+    raise gen.Return(ret)
+
+  @gen.coroutine
+  def fetch_snapshot_many(self, stories, texts_since={}):
+    raise gen.Return(dict(map(lambda story: (story._id,
+      dict(title='title', featured_tweet=None, images=[], veracity=dict(veracity=False, veracity_score=0.0),
+           tweet_texts=['text'], tweet_texts_until=T0)),
+      filter(lambda story: story.event_id != 'no_snapshot', stories))))
+
+  def story(self, event_id):
+    return graphdb.Story(channel_id=Channel._id, event_id=event_id, source_type='twitter', last_activity=T0)
+
+  @gen.coroutine
+  def check_push(self, failing):
+    chunk = map(self.story, ['a', failing, 'b'])
+    failed = yield self.push.push(chunk)
+    self.assertEqual(failed, set([chunk[1]._id]))
+    self.assertEqual(sorted(FakeV3Story.saved), ['a', 'b'])
+    self.assertEqual(self.push.counters['pushed'], 2)
+    self.assertEqual(self.push.counters['failed'], 1)
+    # Only the stories pushed are fingerprinted
+    fingerprints = yield self.push._fingerprints_recall(chunk)
+    self.assertIsNotNone(fingerprints[chunk[0]._id])
+    self.assertIsNone(fingerprints[chunk[1]._id])
+    self.assertIsNotNone(fingerprints[chunk[2]._id])
+    # The pull goes on from the story that failed
+    self.assertEqual(self.pull._consumed_prefix(chunk, failed), chunk[:1])
+
+  @gen_test
+  def test_save_failure(self):
+    yield self.check_push('broken')
+
+  @gen_test
+  def test_missing_snapshot(self):
+    yield self.check_push('no_snapshot')
+
+  @gen_test
+  def test_repeated_story(self):
+    chunk = [ self.story('a'), self.story('b'),
+              graphdb.Story(channel_id=Channel._id, event_id='a', source_type='reddit', last_activity=T0) ]
+    failed = yield self.push.push(chunk)
+    self.assertEqual(failed, set())
+    self.assertEqual(sorted(FakeV3Story.saved), ['a', 'b'])
+    self.assertEqual(self.push.counters['pushed'], 2)
+    aggregates = yield state.get(self.push._aggregates_key(chunk[0]))
+    self.assertEqual(aggregates['size'], 5)
+
+  @gen_test
+  def test_repeated_story_fingerprint(self):
+    reddit = graphdb.Story(channel_id=Channel._id, event_id='a', source_type='reddit', last_activity=T0)
+    yield self.push.push([ self.story('a'), reddit ])
+    self.assertEqual(FakeV3Story.saved, ['a'])
+    # the same story is kept whatever the order it's pulled in
+    yield self.push.push([ reddit, self.story('a') ])
+    self.assertEqual(FakeV3Story.saved, ['a'])
+    self.assertEqual(self.push.counters['skipped_unchanged'], 1)
+
+  def test_retries_given_up(self):
+    chunk = map(self.story, ['a', 'broken', 'b'])
+    failed = set([chunk[1]._id])
+    for i in range(self.pull.max_story_retries - 1):
+      self.assertEqual(self.pull._consumed_prefix(chunk, failed), chunk[:1])
+    self.assertEqual(self.pull._consumed_prefix(chunk, failed), chunk)
+
+if __name__ == '__main__':
+  unittest.main()
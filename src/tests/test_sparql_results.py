@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+import json, pytz, unittest
+
+from repositories import sparql_results
+
+XSD = sparql_results.XSD
+
+def chunks(data, size):
+  return map(lambda i: data[i:i+size], range(0, len(data), size))
+
+JSON_RESULTS = json.dumps({
+  "head": { "vars": [ "s", "text", "n", "score", "ok", "date", "b" ] },
+  "results": { "bindings": [
+    { "s": { "type": "uri", "value": "http://example.org/{1}" },
+      "text": { "type": "literal", "value": u"a \"quoted\" {brace} }\\ and ñ", "xml:lang": "es" },
+      "n": { "type": "literal", "value": "42", "datatype": XSD + "integer" },
+      "score": { "type": "literal", "value": "0.5", "datatype": XSD + "decimal" },
+      "ok": { "type": "literal", "value": "true", "datatype": XSD + "boolean" },
+      "date": { "type": "literal", "value": "2016-01-01T10:00:00Z", "datatype": XSD + "dateTime" },
+      "b": { "type": "bnode", "value": "b0" } },
+    { "text": { "type": "literal", "value": "" },
+      "n": { "type": "typed-literal", "value": "-3", "datatype": XSD + "long" },
+      "score": { "type": "literal", "value": "1e3", "datatype": XSD + "double" },
+      "ok": { "type": "literal", "value": "0", "datatype": XSD + "boolean" } },
+    {} ] }
+}, indent=1, ensure_ascii=False).encode('utf-8')
+
+class JSONResultsDecoderTest(unittest.TestCase):
+  def decode(self, data_chunks):
+    decoder = sparql_results.JSONResultsDecoder()
+    rows = []
+    for data in data_chunks:
+      rows += decoder.feed(data)
+    return rows + decoder.close()
+
+  def test_values(self):
+    rows = self.decode([ JSON_RESULTS ])
+    self.assertEqual(len(rows), 3)
+    self.assertEqual(rows[0], dict(s="http://example.org/{1}", text=u"a \"quoted\" {brace} }\\ and ñ",
+      n=42, score=0.5, ok=True, date=datetime(2016, 1, 1, 10, tzinfo=pytz.utc), b="b0"))
+    self.assertEqual(rows[1], dict(text="", n=-3, score=1000.0, ok=False))
+    # unbound variables read as None
+    self.assertIsNone(rows[1]['s'])
+    self.assertIsNone(rows[2]['text'])
+
+  def test_chunked(self):
+    expected = map(sparql_results.decode_binding, json.loads(JSON_RESULTS)['results']['bindings'])
+    for size in [ 1, 2, 3, 7, 64 ]:
+      self.assertEqual(self.decode(chunks(JSON_RESULTS, size)), expected, "chunks of %d bytes" % size)
+
+  def test_buffer_trimmed(self):
+    # only the data of the row being received is kept
+    data = json.dumps({ "head": { "vars": [ "n" ] }, "results": { "bindings":
+      [ { "n": { "type": "literal", "value": str(i), "datatype": XSD + "integer" } } for i in range(1000) ] } })
+    decoder = sparql_results.JSONResultsDecoder()
+    rows = []
+    for chunk in chunks(data, 5):
+      rows += decoder.feed(chunk)
+      self.assertTrue(len(decoder.buf) < 100)
+    self.assertEqual(map(lambda row: row['n'], rows), range(1000))
+
+  def test_empty(self):
+    self.assertEqual(self.decode([ '{ "head": { "vars": [] }, "results": { "bindings": [ ] } }' ]), [])
+
+  def test_incomplete(self):
+    self.assertRaises(Exception, self.decode, chunks(JSON_RESULTS, 7)[:-10])
+
+TSV_RESULTS = u"\t".join([ u"?s", u"?text", u"?n", u"?score", u"?ok", u"?date", u"?b" ]) + u"\n" + \
+  u"\t".join([ u"<http://example.org/1>", u'"a\\tb \\"quoted\\" \\u00f1 ñ"@es', u'"42"^^<%sinteger>' % XSD,
+                u'"0.5"^^<%sdecimal>' % XSD, u'"true"^^<%sboolean>' % XSD, u'"2016-01-01T10:00:00Z"^^<%sdateTime>' % XSD,
+                u"_:b0" ]) + u"\r\n" + \
+  u"\t".join([ u"", u'""', u"-3", u"1e3", u"false", u"", u"" ]) + u"\n" + \
+  u"\t".join([ u"", u'"x"', u"2.5", u"", u"true", u"", u"" ])
+TSV_RESULTS = TSV_RESULTS.encode('utf-8')
+
+class TSVResultsDecoderTest(unittest.TestCase):
+  def decode(self, data_chunks, decoder=None):
+    decoder = decoder or sparql_results.TSVResultsDecoder()
+    rows = []
+    for data in data_chunks:
+      rows += decoder.feed(data)
+    return rows + decoder.close()
+
+  def test_values(self):
+    rows = self.decode([ TSV_RESULTS ])
+    self.assertEqual(len(rows), 3)
+    self.assertEqual(rows[0], dict(s=u"http://example.org/1", text=u"a\tb \"quoted\" ñ ñ",
+      n=42, score=0.5, ok=True, date=datetime(2016, 1, 1, 10, tzinfo=pytz.utc), b=u"b0"))
+    # empty fields are unbound variables
+    self.assertEqual(rows[1], dict(s=None, text=u"", n=-3, score=1000.0, ok=False, date=None, b=None))
+    self.assertEqual(rows[2], dict(s=None, text=u"x", n=2.5, score=None, ok=True, date=None, b=None))
+
+  def test_chunked(self):
+    expected = self.decode([ TSV_RESULTS ])
+    for size in [ 1, 2, 3, 7, 64 ]:
+      self.assertEqual(self.decode(chunks(TSV_RESULTS, size)), expected, "chunks of %d bytes" % size)
+
+  def test_term_values(self):
+    value = sparql_results.tsv_term_value
+    self.assertEqual(value(u'"a\\nb"'), u"a\nb")
+    self.assertEqual(value(u'"\\U0001F600"'), u"\U0001F600")
+    self.assertEqual(value(u'"3"^^<%slong>' % XSD), 3)
+    self.assertEqual(value(u'"3"^^<http://example.org/type>'), u"3")
+    self.assertEqual(value(u'"tab@home"@en'), u"tab@home")
+    self.assertEqual(value(u"0"), 0)
+    self.assertEqual(value(u"-1.5"), -1.5)
+    self.assertIsNone(value(u""))
+
+  def test_single_var(self):
+    # a row with a single unbound variable is an empty line
+    rows = self.decode([ "?n\n1\n\n3\n" ])
+    self.assertEqual(map(lambda row: row['n'], rows), [ 1, None, 3 ])
+
+  def test_empty(self):
+    self.assertEqual(self.decode([ "?s\t?n\n" ]), [])
+    self.assertRaises(Exception, self.decode, [ "" ])
+
+if __name__ == '__main__':
+  unittest.main()
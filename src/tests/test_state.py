@@ -0,0 +1,165 @@
+import os, shutil, tempfile, unittest
+
+import state
+import state_backends
+
+class LRUCacheFillTest(unittest.TestCase):
+  def setUp(self):
+    self.cache = state.LRUCache(max_size=2, ttls={})
+
+  def test_fill(self):
+    token = self.cache.read_started('a')
+    self.cache.fill('a', 1, None, token)
+    self.assertEqual(self.cache.lookup('a'), (True, 1))
+
+  def test_fill_after_set(self):
+    token = self.cache.read_started('a')
+    self.cache.put('a', 2)
+    self.cache.fill('a', 1, None, token)
+    self.assertEqual(self.cache.lookup('a'), (True, 2))
+
+  def test_fill_after_set_and_eviction(self):
+    token = self.cache.read_started('a')
+    self.cache.put('a', 2)
+    self.cache.put('b', 0)
+    self.cache.put('c', 0)
+    self.assertEqual(self.cache.lookup('a'), (False, None))
+    self.cache.fill('a', 1, None, token)
+    self.assertEqual(self.cache.lookup('a'), (False, None))
+    self.assertEqual(self.cache.reading, {})
+    self.assertEqual(self.cache.written, {})
+
+  def test_concurrent_reads(self):
+    token1 = self.cache.read_started('a')
+    token2 = self.cache.read_started('a')
+    self.cache.fill('a', 1, None, token1)
+    self.cache.put('a', 2)
+    self.cache.put('b', 0)
+    self.cache.put('c', 0)
+    self.cache.fill('a', 1, None, token2)
+    self.assertEqual(self.cache.lookup('a'), (False, None))
+    token3 = self.cache.read_started('a')
+    self.cache.fill('a', 2, None, token3)
+    self.assertEqual(self.cache.lookup('a'), (True, 2))
+
+  def test_fill_after_delete_prefix(self):
+    token = self.cache.read_started('a.1')
+    self.cache.delete_prefix('a.')
+    self.cache.fill('a.1', 1, None, token)
+    self.assertEqual(self.cache.lookup('a.1'), (False, None))
+    token = self.cache.read_started('a.1')
+    self.cache.fill('a.1', 1, None, token)
+    self.assertEqual(self.cache.lookup('a.1'), (True, 1))
+
+class LRUCacheTTLTest(unittest.TestCase):
+  def test_not_cached(self):
+    cache = state.LRUCache(max_size=2, ttls={ 'big.': 0 })
+    cache.put('big.1', 1)
+    self.assertEqual(cache.lookup('big.1'), (False, None))
+    token = cache.read_started('big.1')
+    cache.fill('big.1', 1, None, token)
+    self.assertEqual(cache.lookup('big.1'), (False, None))
+    cache.put('small', 1)
+    self.assertEqual(cache.lookup('small'), (True, 1))
+
+class SweepDefaultTTLsTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def check_backend(self, name):
+    db = state_backends.open_backend(name, self.dir + '/' + name)
+    ttls = { 'legacy.': 100, 'legacy.short.': 10 }
+    db.set('legacy.a', 1)
+    db.set('legacy.short.a', 2)
+    db.set('other', 3)
+    db.set('legacy.b', 4, 50)
+    self.assertEqual(db.sweep(0, 10, ttls), (0, 2, True))
+    self.assertEqual(db.get('legacy.a', 0), (1, 100))
+    self.assertEqual(db.get('legacy.short.a', 0), (2, 10))
+    self.assertEqual(db.get('other', 0), (3, None))
+    self.assertEqual(db.get('legacy.b', 0), (4, 50))
+    self.assertEqual(db.sweep(60, 10, ttls), (2, 0, True))
+    self.assertEqual(db.get('legacy.a', 60), (1, 100))
+    self.assertEqual(db.get('other', 60), (3, None))
+    db.close()
+
+  def test_shelve(self):
+    self.check_backend('shelve')
+
+  def test_sqlite(self):
+    self.check_backend('sqlite')
+
+class OpenBackendsTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = self.dir + '/state'
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def open(self, name, shards):
+    return state_backends.open_backends(name, self.path, shards=shards, shard_of=state.shard_of)
+
+  def close(self, dbs):
+    for db in dbs:
+      db.close()
+
+  def keys(self, dbs):
+    return sorted(sum(map(lambda db: map(lambda item: item[0], db.items()), dbs), []))
+
+  def test_reshard(self):
+    dbs = self.open('shelve', 1)
+    for i in range(20):
+      dbs[0].set('k%d' % i, i)
+    self.close(dbs)
+    expected = sorted(map(lambda i: 'k%d' % i, range(20)))
+    for (name, shards) in [ ('sqlite', 2), ('sqlite', 4), ('shelve', 1) ]:
+      dbs = self.open(name, shards)
+      self.assertEqual(self.keys(dbs), expected)
+      dbs[0].set('k0', name + str(shards))
+      self.close(dbs)
+      # only the store just opened is left
+      self.assertEqual(len(state_backends._layouts(self.path)), 1)
+    dbs = self.open('shelve', 1)
+    self.assertEqual(dbs[0].get('k0', 0), ('shelve1', None))
+    self.close(dbs)
+    self.assertTrue(os.path.exists(self.path + '.shard0of2.sqlite.retired'))
+
+  def make_store(self, name, shards, mtime):
+    dbs = self.open(name, shards)
+    dbs[0].set('k', name)
+    self.close(dbs)
+    for f in state_backends._files(state_backends._layouts(self.path)[-1]):
+      os.utime(f, (mtime, mtime))
+
+  def stores(self, *layouts):
+    # make the given stores, each without the others seeing it
+    for (i, (name, shards, mtime)) in enumerate(layouts):
+      os.mkdir('%s/%d' % (self.dir, i))
+      self.path = '%s/%d/state' % (self.dir, i)
+      self.make_store(name, shards, mtime)
+    for i in range(len(layouts)):
+      for f in os.listdir('%s/%d' % (self.dir, i)):
+        os.rename('%s/%d/%s' % (self.dir, i, f), '%s/%s' % (self.dir, f))
+    self.path = self.dir + '/state'
+
+  def test_stale_store_retired(self):
+    self.stores(('sqlite', 2, 2000), ('shelve', 1, 1000))
+    dbs = self.open('sqlite', 2)
+    self.assertEqual(self.keys(dbs), [ 'k' ])
+    self.close(dbs)
+    self.assertFalse(state_backends.ShelveBackend.exists(self.path))
+
+  def test_newer_store_refused(self):
+    self.stores(('sqlite', 2, 1000), ('shelve', 1, 2000))
+    self.assertRaises(Exception, self.open, 'sqlite', 2)
+
+  def test_ambiguous_stores_refused(self):
+    self.stores(('sqlite', 2, 1000), ('shelve', 1, 2000))
+    self.assertRaises(Exception, self.open, 'sqlite', 4)
+
+if __name__ == '__main__':
+  unittest.main()
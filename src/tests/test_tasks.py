@@ -0,0 +1,39 @@
+from tornado.testing import AsyncTestCase, gen_test
+from tornado import gen
+import unittest
+
+import tasks
+
+class SlowTask(tasks.RecurrentTask):
+  def __init__(self, **kwargs):
+    super(SlowTask, self).__init__(**kwargs)
+    self.running = 0
+    self.max_running = 0
+
+  @gen.coroutine
+  def workload(self):
+    self.running += 1
+    self.max_running = max(self.max_running, self.running)
+    try:
+      yield gen.sleep(0.2)
+    finally:
+      self.running -= 1
+
+class TimeoutTest(AsyncTestCase):
+  @gen_test
+  def test_no_overlap(self):
+    task = SlowTask(task_id='slow', timeout=0.05)
+    yield task._exec()
+    self.assertEqual(task.log.n_error, 1)
+    self.assertIsNotNone(task.current_future)
+    # the workload that timed out is still running
+    yield task._exec()
+    self.assertEqual(task.log.n_execs, 1)
+    yield gen.sleep(0.2)
+    self.assertIsNone(task.current_future)
+    yield task._exec()
+    self.assertEqual(task.log.n_execs, 2)
+    self.assertEqual(task.max_running, 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,47 +1,188 @@
-from tornado import gen, process
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado import gen, locks
+from datetime import timedelta
 
+import http_clients
 import state
 
-import re, logging, md5
+import urlparse, logging, md5, re
 
 logger = logging.getLogger('tornado.general')
 
+# Canonical urls are remembered for a month
+CANONICAL_URL_TTL = 30 * 24 * 3600
+
+# Urls that couldn't be resolved (no response, server errors, too many
+# redirects) are not tried again for this long
+CANONICAL_URL_FAILURE_TTL = 15 * 60
+
+# Redirects followed at most when resolving a canonical url
+CANONICAL_URL_MAX_HOPS = 10
+
+# Canonical urls resolved concurrently at most per host (the total is bounded
+# by the max clients of the "links" upstream)
+CANONICAL_URL_HOST_CONCURRENCY = 4
+
+# Seconds get_canonical_urls waits for the resolutions to finish
+CANONICAL_URLS_DEADLINE = 3
+
+# Known canonicalisations, that need no network. They are applied to the url
+# before and after following its redirects.
+#
+# Query parameters that only track where a visit comes from are removed
+_tracking_param_re = re.compile(r'^(utm_[^=]*|fbclid|gclid)$', re.IGNORECASE)
+
+def _youtu_be(p):
+	# youtu.be/<id> -> www.youtube.com/watch?v=<id>
+	query = "v=%s" % p.path.strip('/') + ("&%s" % p.query if p.query else "")
+	return p._replace(netloc="www.youtube.com", path="/watch", query=query)
+
+# Rules for known hosts, as (host regex, replacement host or function of the
+# split url), the first matching rule is applied
+_host_rules = map(lambda (host_re, rule): (re.compile(host_re), rule), [
+	(r'^youtu\.be$', _youtu_be),
+	(r'^(m\.)?youtube\.com$', 'www.youtube.com'),
+	(r'^(m|mobile|www)\.twitter\.com$', 'twitter.com'),
+	(r'^(m\.)?facebook\.com$', 'www.facebook.com'),
+	(r'^(\w+)\.m\.wikipedia\.org$', r'\1.wikipedia.org'),
+	])
+
+# Hosts whose urls are known not to redirect anywhere else
+_final_host_re = re.compile(r'^(www\.youtube\.com|twitter\.com|www\.facebook\.com|\w+\.wikipedia\.org)$')
+
+def _apply_rules(url):
+	# Returns (url, final): url with the known canonicalisations applied, and
+	# whether there's no need to follow its redirects
+	p = urlparse.urlsplit(url)
+	if p.scheme not in [ 'http', 'https' ]:
+		return (url, False)
+	p = p._replace(netloc=p.netloc.lower())
+	for (host_re, rule) in _host_rules:
+		if host_re.match(p.netloc):
+			p = rule(p) if callable(rule) else p._replace(netloc=host_re.sub(rule, p.netloc))
+			break
+	if p.query:
+		params = p.query.split('&')
+		p = p._replace(query='&'.join(filter(lambda param: not _tracking_param_re.match(param.split('=', 1)[0]), params)))
+	return (urlparse.urlunsplit(p), _final_host_re.match(p.netloc) is not None)
+
+@gen.coroutine
+def _fetch_hop(url, method):
+	# Request url without following redirects, returns the response (also for
+	# error statuses) or None if there was no response at all
+	if method == 'GET':
+		# the body is of no use, don't keep it
+		r = HTTPRequest(url, method='GET', follow_redirects=False, streaming_callback=lambda chunk: None)
+	else:
+		r = HTTPRequest(url, method='HEAD', follow_redirects=False)
+	try:
+		response = yield http_clients.get_upstream('links').fetch(r)
+	except HTTPError as e:
+		response = e.response
+	except Exception as e:
+		logger.info("Error requesting %s %s: %s" % (method, url, str(e)))
+		response = None
+	raise gen.Return(response)
+
 @gen.coroutine
+def _resolve_redirects(url):
+	# Follows the redirects from url, with HEAD requests (GET if the server
+	# rejects those with a 4xx error). Returns (location, ok): the last location
+	# found, and whether the last request got a definitive answer
+	location = url
+	for hop in range(CANONICAL_URL_MAX_HOPS):
+		response = yield _fetch_hop(location, 'HEAD')
+		if response is not None and response.code >= 400 and response.code < 500:
+			response = yield _fetch_hop(location, 'GET')
+		if response is None or response.code >= 500:
+			raise gen.Return((location, False))
+		if response.code < 300 or response.code >= 400:
+			break
+		next_location = response.headers.get('Location')
+		if not next_location:
+			break
+		location = urlparse.urljoin(location, next_location.strip())
+	else:
+		logger.info("Too many redirects from %s" % url)
+		raise gen.Return((location, False))
+	raise gen.Return((location, True))
+
+# Per host semaphore, with the number of resolutions using it
+_host_slots = {}
+
+@gen.coroutine
+def _resolve_redirects_limited(url):
+	# _resolve_redirects, waiting for a free slot for the host of url first
+	host = urlparse.urlparse(url).netloc.lower()
+	if host not in _host_slots:
+		_host_slots[host] = [ locks.Semaphore(CANONICAL_URL_HOST_CONCURRENCY), 0 ]
+	slot = _host_slots[host]
+	slot[1] += 1
+	try:
+		yield slot[0].acquire()
+		try:
+			result = yield _resolve_redirects(url)
+		finally:
+			slot[0].release()
+	finally:
+		slot[1] -= 1
+		if slot[1] == 0:
+			del _host_slots[host]
+	raise gen.Return(result)
+
+# Resolutions in flight, by url hash
+_flights = http_clients.SingleFlight()
+
 def get_canonical_url(url):
+	# Concurrent calls for the same url share a single resolution
+	hash_key = md5.new(url.encode('utf-8') if isinstance(url, unicode) else url).hexdigest()
+	return _flights.do(hash_key, lambda: _get_canonical_url(url, hash_key))
+
+@gen.coroutine
+def _get_canonical_url(url, hash_key):
 
 	# Check if the result is cached in the state
-	hash_key = md5.new(url).hexdigest()
 	result = yield state.get("canonical_url_%s" % hash_key)
 	if result is not None:
 		raise gen.Return(result)
 
-	sub_process = process.Subprocess(
-		args= "curl -sIL '%s' | grep -i ^location:" % url,
-		shell= True,
-		stdout= process.Subprocess.STREAM,
-		stderr= process.Subprocess.STREAM)
-	
-	result, error = yield [
-        gen.Task(sub_process.stdout.read_until_close),
-        gen.Task(sub_process.stderr.read_until_close)
-        ]
-	logger.info("Subprocess result: " + str(result))
-	logger.info("Subprocess error: " + str(error))
-
-	result = result.splitlines()
-	if len(result) >= 1:
-		result = result[-1]
-		result = re.match("location:\s*(.*)$", result, re.IGNORECASE)
-		if result and result.groups()[0]:
-			result = result.groups()[0]
-		else:
-			result = url
-	else:
-		# Either the url is canonical or we are broken
-		result = url
+	(result, final) = _apply_rules(url)
+	ttl = CANONICAL_URL_TTL
+	if not final:
+		# Either the url is canonical (no redirects) or we are broken, in both
+		# cases the url itself is returned
+		(result, ok) = yield _resolve_redirects_limited(result)
+		(result, final) = _apply_rules(result)
+		if not ok:
+			ttl = CANONICAL_URL_FAILURE_TTL
+	logger.info("Canonical url of %s: %s" % (url, result))
 
 	# Cache the result
 	if result is not None:
-		state.set("canonical_url_%s" % hash_key, result)
+		state.set("canonical_url_%s" % hash_key, result, ttl=ttl)
 
-	raise gen.Return(result)
\ No newline at end of file
+	raise gen.Return(result)
+
+@gen.coroutine
+def get_canonical_urls(urls, deadline=None):
+	# Resolves the canonical urls of many urls concurrently, returns a dict of
+	# url -> canonical url. The urls not resolved within deadline (seconds,
+	# CANONICAL_URLS_DEADLINE by default) map to themselves, their resolution
+	# goes on to fill the cache.
+	if deadline is None:
+		deadline = CANONICAL_URLS_DEADLINE
+	futures = dict(map(lambda url: (url, get_canonical_url(url)), set(urls)))
+	try:
+		yield gen.with_timeout(timedelta(seconds=deadline), gen.multi_future(futures.values()))
+	except gen.TimeoutError:
+		pending = len(filter(lambda f: not f.done(), futures.values()))
+		logger.info("%d of %d canonical urls not resolved within %ds" % (pending, len(futures), deadline))
+	except Exception as e:
+		logger.info("Error resolving canonical urls: %s" % str(e))
+	ret = {}
+	for (url, future) in futures.iteritems():
+		if future.done() and future.exception() is None:
+			ret[url] = future.result()
+		else:
+			ret[url] = url
+	raise gen.Return(ret)